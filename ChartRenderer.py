@@ -0,0 +1,109 @@
+import requests
+import hashlib
+import json
+import os
+import time
+from DiscordPayloads import dispatch_to_destinations
+
+# Get the directory where the script is located
+script_directory = os.path.dirname(os.path.abspath(__file__))
+chart_cache_directory = os.path.join(script_directory, 'ChartCache')
+chart_cache_days = 30
+
+# Colors used by the reports for each media type, with a fallback for anything else
+chart_colors = {'TV': '#009ebb', 'Movies': '#cc7700', 'Music': '#2ecc71', 'Live TV': '#9b59b6'}
+default_chart_color = '#e5a00d'
+
+
+def get_chart_hash(chart_data):
+    # The cache is keyed on the chart's input data, so an unchanged dataset maps to the same PNG
+    return hashlib.sha256(json.dumps(chart_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def prune_chart_cache():
+    # Remove charts that have not been used recently
+    oldest_use = time.time() - chart_cache_days * 86400
+    for file_name in os.listdir(chart_cache_directory):
+        file_path = os.path.join(chart_cache_directory, file_name)
+        if os.path.getmtime(file_path) < oldest_use:
+            os.remove(file_path)
+
+
+def render_bar_chart(title, labels, series, stacked=False, horizontal=False):
+    # Render a bar chart to a PNG and return its path, or None if matplotlib is not installed.
+    # series maps each series name to one value per label.
+    chart_data = {'title': title, 'labels': labels, 'series': series, 'stacked': stacked, 'horizontal': horizontal}
+    os.makedirs(chart_cache_directory, exist_ok=True)
+    chart_path = os.path.join(chart_cache_directory, f"{get_chart_hash(chart_data)}.png")
+
+    # Reuse the previous render if the data has not changed
+    if os.path.exists(chart_path):
+        os.utime(chart_path)
+        return chart_path
+
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print('matplotlib is not installed, charts cannot be rendered.')
+        return None
+
+    figure, axes = plt.subplots(figsize=(8, max(3, len(labels) * 0.5) if horizontal else 4.5))
+    positions = list(range(len(labels)))
+    bar_width = 0.8 if stacked or len(series) == 1 else 0.8 / len(series)
+    offsets = [0] * len(labels)
+
+    for index, (name, values) in enumerate(series.items()):
+        color = chart_colors.get(name, default_chart_color)
+        if stacked:
+            bar_positions = positions
+        else:
+            bar_positions = [position + (index - (len(series) - 1) / 2) * bar_width for position in positions]
+        if horizontal:
+            axes.barh(bar_positions, values, height=bar_width, left=offsets if stacked else None, label=name, color=color)
+        else:
+            axes.bar(bar_positions, values, width=bar_width, bottom=offsets if stacked else None, label=name, color=color)
+        if stacked:
+            offsets = [offset + value for offset, value in zip(offsets, values)]
+
+    if horizontal:
+        axes.set_yticks(positions)
+        axes.set_yticklabels(labels)
+        axes.invert_yaxis()
+    else:
+        axes.set_xticks(positions)
+        axes.set_xticklabels(labels, rotation=45, ha='right')
+    axes.set_title(title)
+    if len(series) > 1:
+        axes.legend()
+    figure.tight_layout()
+
+    # Write to a temporary file first so a failed render never leaves a partial PNG in the cache
+    temp_path = f"{chart_path}.tmp"
+    figure.savefig(temp_path, format='png')
+    plt.close(figure)
+    os.replace(temp_path, chart_path)
+    prune_chart_cache()
+    return chart_path
+
+
+def push_charts_to_discord(webhook, chart_paths, content=None):
+    # Upload the charts as attachments of a single webhook message. Discord allows up to 10 files per message.
+    for start in range(0, len(chart_paths), 10):
+        payload = {'content': content} if content and start == 0 else {}
+        files = {}
+        for index, chart_path in enumerate(chart_paths[start:start + 10]):
+            with open(chart_path, 'rb') as chart_file:
+                files[f"files[{index}]"] = (f"chart{index}.png", chart_file.read(), 'image/png')
+        try:
+            response = requests.post(webhook, data={'payload_json': json.dumps(payload)}, files=files)
+            response.raise_for_status()
+            print("Charts sent to Discord successfully.")
+        except requests.exceptions.RequestException as e:
+            print(f"Error sending charts to Discord: {e}")
+
+
+def dispatch_charts(destinations, chart_paths, content=None):
+    # Send the same rendered charts to every destination at once
+    dispatch_to_destinations(destinations, lambda destination: push_charts_to_discord(destination['Webhook'], chart_paths, content))
@@ -1,40 +1,47 @@
 import requests
 import json
 import unicodedata
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
+from DiscordPayloads import dispatch, get_destinations, pack_embeds
+from Servers import fan_out, get_clients
+from TMDBMetadata import get_tmdb_info, is_store_modified, load_metadata_store, save_metadata_store
 
-def main():
-    def load_config():
-        with open(config_path, 'r') as config_file:
-            return json.load(config_file)
+# Get the directory where the script is located
+script_directory = os.path.dirname(os.path.abspath(__file__))
+config_path = os.path.join(script_directory, 'config.json')
+
+# Aggregate fields of Tautulli's get_activity that are summed across servers
+activity_totals = ['stream_count', 'stream_count_direct_play', 'stream_count_direct_stream', 'stream_count_transcode',
+                   'total_bandwidth', 'wan_bandwidth', 'lan_bandwidth']
+
+def is_hardware_transcode(stream):
+    return str(stream.get('transcode_hw_decoding')) == '1' or str(stream.get('transcode_hw_encoding')) == '1'
+
+def update_peaks(peaks_path, current_load, peak_days):
+    # Keep the daily maximum of each load value for the last <peak_days> days, and return the peaks across them
+    peaks = {}
+    if os.path.exists(peaks_path):
+        with open(peaks_path, 'r') as peaks_file:
+            peaks = json.load(peaks_file)
     
-    def get_tmdb_info(tmdb_api_key, media_type, tmdb_id=None, title=None, year=None):
-        # If TMDB ID found in Tautulli, use it to lookup the media information
-        if tmdb_id != None:
-            media_url = f"https://api.themoviedb.org/3/{media_type}/{tmdb_id}?api_key={tmdb_api_key}&language=en-US"
-            media_results = requests.get(media_url).json()
-            if "success" in media_results and media_results["success"] is False:
-                # If TMDB ID lookup returns no data, return None
-                return None
-            return media_results
-        # No TMDB ID, so we will attempt to search TMDB for the media information
-        else:
-            tmdb_url = f"https://api.themoviedb.org/3/search/{media_type}?api_key={tmdb_api_key}&language=en-US&page=1&include_adult=false&query={title}"
-            if year is not None and year != '':
-                tmdb_url += f"&year={year}"
-            
-            tmdb_results = requests.get(tmdb_url).json()
-            # Check if 'results' key exists and the list is not empty
-            if 'results' in tmdb_results and len(tmdb_results['results']) > 0:
-                # Get the first TMDB ID from the search results
-                media_id = tmdb_results['results'][0]['id']
-                media_url = f"https://api.themoviedb.org/3/{media_type}/{media_id}?api_key={tmdb_api_key}&language=en-US"
-                media_results = requests.get(media_url).json()
-                return media_results
-        
-        return None
+    today = datetime.now().strftime('%Y-%m-%d')
+    oldest_day = (datetime.now() - timedelta(days=peak_days - 1)).strftime('%Y-%m-%d')
+    today_peaks = peaks.get(today, {})
+    updated_peaks = {day: day_peaks for day, day_peaks in peaks.items() if day >= oldest_day}
+    updated_peaks[today] = {name: max(value, today_peaks.get(name, 0)) for name, value in current_load.items()}
     
+    if updated_peaks != peaks:
+        with open(peaks_path, 'w') as peaks_file:
+            json.dump(updated_peaks, peaks_file)
+    
+    return {name: max(day_peaks.get(name, 0) for day_peaks in updated_peaks.values()) for name in current_load}
+
+def load_config():
+    with open(config_path, 'r') as config_file:
+        return json.load(config_file)
+
+def run(config, clients):
     def get_sanitized_string(input_string):
         # Replace any non-ASCII characters with their closest ASCII representation
         normalized_string = unicodedata.normalize('NFKD', input_string).encode('ASCII', 'ignore').decode('utf-8')
@@ -46,65 +53,66 @@ def main():
         
         return normalized_string
     
-    def push_to_discord(discord_webhook, payload):
-        headers = {'Content-Type': 'application/json'}
-        try:
-            response = requests.post(discord_webhook, json=payload, headers=headers)
-            response.raise_for_status()
-            print("Data sent to Discord successfully.")
-        except requests.exceptions.RequestException as e:
-            print(f"Error sending to Discord: {e}")
-            print(f"Response content: {response.content}")
-            print(payload)
-    
-    # Get the directory where the script is located
-    script_directory = os.path.dirname(os.path.abspath(__file__))
-    config_path = os.path.join(script_directory, 'config.json')
     stream_log_path = os.path.join(script_directory, 'StreamLog.txt')
+    peaks_path = os.path.join(script_directory, 'StreamPeaks.json')
     
-    # Parse the config file and assign variables
-    config = load_config()
+    # Assign variables from the config
     script_name = 'CurrentStreams'
     script_settings = config['ScriptSettings'][script_name]
-    discord_webhook = script_settings['Webhook']
-    tautulli_url = config['Tautulli']['Url']
-    tautulli_api_key = config['Tautulli']['APIKey']
+    destinations = get_destinations(script_settings)
+    capacity_panel = script_settings.get('CapacityPanel', True)
+    max_transcodes = script_settings.get('MaxTranscodes', 0)
+    wan_bandwidth_ceiling = script_settings.get('WanBandwidthCeilingMbps', 0)
+    capacity_warning_percent = script_settings.get('CapacityWarningPercent', 80)
+    peak_days = script_settings.get('PeakDays', 7)
+    tautulli_instances = clients['Tautulli']
     tmdb_api_key = config['TMDB']['APIKey']
+    tmdb_store = load_metadata_store()
     
-    # Get PMS Identifier
-    response = requests.get(f"{tautulli_url}/api/v2", params={"apikey": tautulli_api_key, "cmd": "get_server_info"})
-    plex_server_identifier = response.json()["response"]["data"]["pms_identifier"]
+    def get_server_sessions(tautulli):
+        # Get the PMS Identifier and the Plex activity of a single server
+        tautulli_params = {"apikey": tautulli['APIKey']}
+        response = requests.get(f"{tautulli['Url']}/api/v2", params=dict(tautulli_params, cmd="get_server_info"), timeout=tautulli['Timeout'])
+        plex_server_identifier = response.json()["response"]["data"]["pms_identifier"]
+        
+        response = requests.get(f"{tautulli['Url']}/api/v2", params=dict(tautulli_params, cmd="get_activity"), timeout=tautulli['Timeout'])
+        activity = response.json()['response']['data']
+        for stream in activity['sessions']:
+            stream['plex_server_identifier'] = plex_server_identifier
+            stream['server_name'] = tautulli['Name']
+        return activity
     
-    # Attempt to get Plex activity from Tautulli
-    try:
-        activity_url = f"{tautulli_url}/api/v2?apikey={tautulli_api_key}&cmd=get_activity"
-        response = requests.get(activity_url)
-        current_activity = response.json()
-        sessions = current_activity['response']['data']['sessions']
-    except Exception as e:
+    # Attempt to get Plex activity from every Tautulli server at once
+    server_activity = fan_out(tautulli_instances, get_server_sessions)
+    if not server_activity:
         payload = {
             'username': 'Current Streams',
-            'content': f'**Could not get current streams from Tautulli.**\nError message:\n{e}'
+            'content': '**Could not get current streams from Tautulli.**\nSee the script output for the error messages.'
         }
-        push_to_discord(discord_webhook, payload)
-        exit()
+        dispatch(destinations, [payload])
+        return
+    sessions = [stream for _, activity in server_activity for stream in activity['sessions']]
+    activity_total = {name: sum(int(activity.get(name) or 0) for _, activity in server_activity) for name in activity_totals}
 
     # Loop through each stream
     sessions_embed = []
     for stream in sessions:
         sanitized_title = get_sanitized_string(stream['title'])
-        tmdb_id = None
+        plex_server_identifier = stream['plex_server_identifier']
+        
+        # Name the server the stream is on if there is more than one
+        footer_text = f'{stream["state"]} - {stream["progress_percent"]}%'
+        if len(tautulli_instances) > 1:
+            footer_text += f' - {stream["server_name"]}'
+        
+        stream_decision = stream['transcode_decision']
+        if stream_decision == 'transcode':
+            stream_decision += ' (HW)' if is_hardware_transcode(stream) else ' (SW)'
         
         # TV
         if stream['media_type'] == 'episode':
-            tmdb_guid = next((guid for guid in stream['grandparent_guids'] if guid.startswith("tmdb://")), None)
-            
-            if tmdb_guid:
-                # Extract the TMDB ID from the TMDB GUID
-                tmdb_id = tmdb_guid.split("tmdb://")[1]
-            
             sanitized_full_title = stream['full_title'] # "<Show Name> - <Episode Name>"
-            tmdb_tv_results = get_tmdb_info(tmdb_api_key, 'tv', tmdb_id, sanitized_title, stream['year'])
+            tmdb_tv_results = get_tmdb_info(tmdb_api_key, 'tv', title=sanitized_title, year=stream['year'], store=tmdb_store, guids=stream['grandparent_guids'])
             
             # Base embed parameters for TV
             embed_params = {
@@ -119,29 +127,24 @@ def main():
                 'fields': [
                     {'name': 'User', 'value': stream['friendly_name'], 'inline': False},
                     {'name': 'Season', 'value': stream['parent_media_index'], 'inline': True},
-                    {'name': 'Episode', 'value': stream['media_index'], 'inline': True}
+                    {'name': 'Episode', 'value': stream['media_index'], 'inline': True},
+                    {'name': 'Direct Play/Transcode', 'value': stream_decision, 'inline': True}
                 ],
-                'footer': {'text': f'{stream["state"]} - {stream["progress_percent"]}%'},
+                'footer': {'text': footer_text},
                 'timestamp': datetime.utcnow().isoformat()
             }
             
             if tmdb_tv_results:
                 print(stream["title"], ' - Has TMdB results.')
                 # Add TV-specific fields if TMDB results are available
-                embed_params['url'] = f'https://www.themoviedb.org/tv/{tmdb_id}'
+                embed_params['url'] = f'https://www.themoviedb.org/tv/{tmdb_tv_results["id"]}'
                 embed_params['thumbnail'] = {'url': f'https://image.tmdb.org/t/p/w500{tmdb_tv_results["poster_path"]}'}
             else:
-                print(stream["title"], ' - Does not have TMdB results. tmdb_id:', tmdb_id)
+                print(stream["title"], ' - Does not have TMdB results.')
         
         # MOVIE
         elif stream['media_type'] == 'movie':
-            tmdb_guid = next((guid for guid in stream['guids'] if guid.startswith("tmdb://")), None)
-            
-            if tmdb_guid:
-                # Extract the TMDB ID from the TMDB GUID
-                tmdb_id = tmdb_guid.split("tmdb://")[1]
-            
-            tmdb_movie_results = get_tmdb_info(tmdb_api_key, 'movie', tmdb_id, sanitized_title, stream['year'])
+            tmdb_movie_results = get_tmdb_info(tmdb_api_key, 'movie', title=sanitized_title, year=stream['year'], store=tmdb_store, guids=stream['guids'])
             
             # Base embed parameters for MOVIE
             embed_params = {
@@ -156,19 +159,19 @@ def main():
                 'fields': [
                     {'name': 'User', 'value': stream['friendly_name'], 'inline': False},
                     {'name': 'Resolution', 'value': stream['stream_video_full_resolution'], 'inline': True},
-                    {'name': 'Direct Play/Transcode', 'value': stream['transcode_decision'], 'inline': True}
+                    {'name': 'Direct Play/Transcode', 'value': stream_decision, 'inline': True}
                 ],
-                'footer': {'text': f'{stream["state"]} - {stream["progress_percent"]}%'},
+                'footer': {'text': footer_text},
                 'timestamp': datetime.utcnow().isoformat()
             }
             
             if tmdb_movie_results:
                 print(stream["title"], ' - Has TMdB results.')
                 # Add MOVIE-specific fields if TMDB results are available
-                embed_params['url'] = f'https://www.themoviedb.org/movie/{tmdb_id}'
+                embed_params['url'] = f'https://www.themoviedb.org/movie/{tmdb_movie_results["id"]}'
                 embed_params['thumbnail'] = {'url': f'https://image.tmdb.org/t/p/w500{tmdb_movie_results["poster_path"]}'}
             else:
-                print(stream["title"], ' - Does not have TMdB results. tmdb_id:', tmdb_id)
+                print(stream["title"], ' - Does not have TMdB results.')
         
         # MUSIC
         elif stream['media_type'] == 'track':
@@ -184,18 +187,61 @@ def main():
                 'fields': [
                     {'name': 'User', 'value': stream['friendly_name'], 'inline': False},
                     {'name': 'Album', 'value': stream['parent_title'], 'inline': True},
-                    {'name': 'Track', 'value': stream['media_index'], 'inline': True}
+                    {'name': 'Track', 'value': stream['media_index'], 'inline': True},
+                    {'name': 'Direct Play/Transcode', 'value': stream_decision, 'inline': True}
                 ],
-                'footer': {'text': f'{stream["state"]} - {stream["progress_percent"]}%'},
+                'footer': {'text': footer_text},
                 'timestamp': datetime.utcnow().isoformat()
             }
         
+        # Restricted fields are only sent to destinations with RestrictedFields enabled
+        embed_params['fields'].extend([
+            {'name': 'IP Address', 'value': stream['ip_address'], 'inline': True, 'restricted': True},
+            {'name': 'Bandwidth', 'value': f"{int(stream['bandwidth'] or 0) / 1000:.1f} Mbps", 'inline': True, 'restricted': True}
+        ])
+        
         # Add line results to final object
         sessions_embed.append(embed_params)
     
+    # Keep anything that had to be fetched for the next run
+    if is_store_modified(tmdb_store):
+        save_metadata_store(tmdb_store)
+    
+    # Server load across all servers. Tautulli reports bandwidth in kbps.
+    transcodes = [stream for stream in sessions if stream['transcode_decision'] == 'transcode']
+    hardware_transcode_count = sum(1 for stream in transcodes if is_hardware_transcode(stream))
+    wan_bandwidth = activity_total['wan_bandwidth'] / 1000
+    current_load = {'Streams': activity_total['stream_count'], 'Transcodes': activity_total['stream_count_transcode'], 'WanBandwidth': wan_bandwidth}
+    load_peaks = update_peaks(peaks_path, current_load, peak_days)
+    
+    def get_load(value, ceiling, unit=''):
+        # Show the value against its ceiling when one is configured, returning whether it is near the ceiling
+        if not ceiling:
+            return f"{value:g}{unit}", False
+        percent = round(value / ceiling * 100)
+        return f"{value:g}/{ceiling}{unit} ({percent}%)", percent >= capacity_warning_percent
+    
+    transcode_load, transcodes_near_limit = get_load(activity_total['stream_count_transcode'], max_transcodes)
+    wan_load, wan_near_limit = get_load(round(wan_bandwidth, 1), wan_bandwidth_ceiling, ' Mbps')
+    near_capacity = transcodes_near_limit or wan_near_limit
+    capacity_embed = {
+        'color': 15158332 if near_capacity else 3066993,
+        'title': 'Server Load',
+        'fields': [
+            {'name': 'Streams', 'value': f"{activity_total['stream_count']} ({activity_total['stream_count_direct_play']} direct play, {activity_total['stream_count_direct_stream']} direct stream, {activity_total['stream_count_transcode']} transcode)", 'inline': False},
+            {'name': 'Transcodes', 'value': transcode_load, 'inline': True},
+            {'name': 'Hardware/Software', 'value': f"{hardware_transcode_count} HW / {len(transcodes) - hardware_transcode_count} SW", 'inline': True},
+            {'name': 'WAN Bandwidth', 'value': wan_load, 'inline': True},
+            {'name': 'LAN Bandwidth', 'value': f"{activity_total['lan_bandwidth'] / 1000:.1f} Mbps", 'inline': True},
+            {'name': f'{peak_days} Day Peaks', 'value': f"{load_peaks['Streams']} streams, {load_peaks['Transcodes']} transcodes, {load_peaks['WanBandwidth']:.1f} Mbps WAN", 'inline': False}
+        ],
+        'footer': {'text': 'Near capacity' if near_capacity else 'Updated'},
+        'timestamp': datetime.utcnow().isoformat()
+    }
+    
     # If there are no sessions, make a new payload stating so
     if len(sessions) == 0:
-        payload = {
+        payloads = [{
             'embeds': [
                 {
                     'color': 15158332,
@@ -203,13 +249,12 @@ def main():
                     'timestamp': datetime.utcnow().isoformat()
                 }
             ]
-        }
+        }]
     else:
-        payload = {
-            'username': 'Current Streams',
-            'content': '**Current Streams on Plex:**',
-            'embeds': sessions_embed
-        }
+        # Split the sessions over as many messages as Discord's limits require
+        if capacity_panel:
+            sessions_embed.insert(0, capacity_embed)
+        payloads = pack_embeds(sessions_embed, username='Current Streams', content='**Current Streams on Plex:**')
     
     # Check if the log file exists, create it if not, and populate it with a filler value
     if not os.path.exists(stream_log_path):
@@ -227,7 +272,12 @@ def main():
         # Log file and current stream count are both 0. Do not update.
         print('Nothing to update.')
     else:
-        push_to_discord(discord_webhook, payload)
+        dispatch(destinations, payloads)
+
+
+def main():
+    config = load_config()
+    run(config, get_clients(config))
 
 # Call the main function
 if __name__ == "__main__":
@@ -0,0 +1,190 @@
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+# Discord webhook limits. https://discord.com/developers/docs/resources/message#embed-object-embed-limits
+MAX_CONTENT_LENGTH = 2000
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_MESSAGE_EMBED_LENGTH = 6000
+MAX_TITLE_LENGTH = 256
+MAX_DESCRIPTION_LENGTH = 4096
+MAX_FIELDS_PER_EMBED = 25
+MAX_FIELD_NAME_LENGTH = 256
+MAX_FIELD_VALUE_LENGTH = 1024
+MAX_FOOTER_LENGTH = 2048
+MAX_AUTHOR_NAME_LENGTH = 256
+
+TRUNCATION_SUFFIX = '...'
+
+
+def truncate_string(input_string, max_length):
+    # Cut the string at max_length, marking that it was shortened
+    input_string = str(input_string)
+    if len(input_string) <= max_length:
+        return input_string
+    return input_string[:max_length - len(TRUNCATION_SUFFIX)].rstrip() + TRUNCATION_SUFFIX
+
+
+def get_embed_length(embed):
+    # Discord counts these characters towards the 6000 character limit of a message
+    length = len(str(embed.get('title', '')))
+    length += len(str(embed.get('description', '')))
+    length += len(str(embed.get('footer', {}).get('text', '')))
+    length += len(str(embed.get('author', {}).get('name', '')))
+    for field in embed.get('fields', []):
+        length += len(str(field['name'])) + len(str(field['value']))
+    return length
+
+
+def get_limited_embed(embed):
+    # Return a copy of the embed with every part cut down to Discord's limits
+    embed = dict(embed)
+    if 'title' in embed:
+        embed['title'] = truncate_string(embed['title'], MAX_TITLE_LENGTH)
+    if 'footer' in embed and 'text' in embed['footer']:
+        embed['footer'] = dict(embed['footer'], text=truncate_string(embed['footer']['text'], MAX_FOOTER_LENGTH))
+    if 'author' in embed and 'name' in embed['author']:
+        embed['author'] = dict(embed['author'], name=truncate_string(embed['author']['name'], MAX_AUTHOR_NAME_LENGTH))
+    if 'fields' in embed:
+        embed['fields'] = [
+            dict(field, name=truncate_string(field['name'], MAX_FIELD_NAME_LENGTH), value=truncate_string(field['value'], MAX_FIELD_VALUE_LENGTH))
+            for field in embed['fields'][:MAX_FIELDS_PER_EMBED]
+        ]
+    if 'description' in embed:
+        embed['description'] = truncate_string(embed['description'], MAX_DESCRIPTION_LENGTH)
+        # The description is the only free text, so it is shortened first to fit a single message
+        overflow = get_embed_length(embed) - MAX_MESSAGE_EMBED_LENGTH
+        if overflow > 0:
+            embed['description'] = truncate_string(embed['description'], max(len(embed['description']) - overflow, len(TRUNCATION_SUFFIX)))
+    # If the fields alone are still too long, drop them from the end until the embed fits
+    while embed.get('fields') and get_embed_length(embed) > MAX_MESSAGE_EMBED_LENGTH:
+        embed['fields'] = embed['fields'][:-1]
+    return embed
+
+
+def pack_embeds(embeds, username=None, content=None):
+    # Pack embeds, in order, into as few payloads as the embed count and character limits allow.
+    # The content is only sent with the first payload.
+    payloads = []
+    current_embeds = []
+    current_length = 0
+
+    for embed in embeds:
+        embed = get_limited_embed(embed)
+        embed_length = get_embed_length(embed)
+        if current_embeds and (len(current_embeds) >= MAX_EMBEDS_PER_MESSAGE or current_length + embed_length > MAX_MESSAGE_EMBED_LENGTH):
+            payloads.append(current_embeds)
+            current_embeds = []
+            current_length = 0
+        current_embeds.append(embed)
+        current_length += embed_length
+
+    if current_embeds or content:
+        payloads.append(current_embeds)
+
+    packed_payloads = []
+    for index, payload_embeds in enumerate(payloads):
+        payload = {}
+        if username:
+            payload['username'] = username
+        if content and index == 0:
+            payload['content'] = truncate_string(content, MAX_CONTENT_LENGTH)
+        if payload_embeds:
+            payload['embeds'] = payload_embeds
+        packed_payloads.append(payload)
+
+    return packed_payloads
+
+
+def format_code_block(header, body, max_length=MAX_CONTENT_LENGTH):
+    # Format a header followed by a code block, dropping whole lines from the end of the body if it is too long
+    section = f"{header}\n```\n{body}\n```"
+    if len(section) <= max_length:
+        return section
+
+    lines = body.split('\n')
+    while lines:
+        lines.pop()
+        section = f"{header}\n```\n" + '\n'.join(lines + [TRUNCATION_SUFFIX]) + "\n```"
+        if len(section) <= max_length:
+            return section
+    return truncate_string(header, max_length)
+
+
+def pack_code_blocks(sections, username=None):
+    # Pack formatted sections, in order, into as few message contents as the character limit allows
+    payloads = []
+    current_content = ''
+
+    for section in sections:
+        section = truncate_string(section, MAX_CONTENT_LENGTH)
+        if current_content and len(current_content) + 1 + len(section) > MAX_CONTENT_LENGTH:
+            payloads.append(current_content)
+            current_content = ''
+        current_content = f"{current_content}\n{section}" if current_content else section
+
+    if current_content:
+        payloads.append(current_content)
+
+    packed_payloads = []
+    for content in payloads:
+        payload = {'content': content}
+        if username:
+            payload['username'] = username
+        packed_payloads.append(payload)
+
+    return packed_payloads
+
+
+def get_destinations(script_settings):
+    # A report is sent to every entry in its 'Destinations' list, or to its 'Webhook' if there is no list.
+    # Each destination can set 'ExcludeFields' (embed field names to leave out) and 'RestrictedFields'
+    # (true to receive the fields a report marks as restricted, e.g. IP addresses).
+    if 'Destinations' in script_settings:
+        return script_settings['Destinations']
+    return [{'Webhook': script_settings['Webhook']}]
+
+
+def get_destination_payload(payload, destination):
+    # Derive a destination's copy of a payload by filtering its embed fields. The payload itself is not changed.
+    if 'embeds' not in payload:
+        return payload
+    excluded_fields = set(destination.get('ExcludeFields', []))
+    restricted_fields = destination.get('RestrictedFields', False)
+    embeds = []
+    for embed in payload['embeds']:
+        if 'fields' in embed:
+            embed = dict(embed, fields=[
+                {key: value for key, value in field.items() if key != 'restricted'}
+                for field in embed['fields']
+                if field['name'] not in excluded_fields and (restricted_fields or not field.get('restricted', False))
+            ])
+        embeds.append(embed)
+    return dict(payload, embeds=embeds)
+
+
+def push_to_discord(webhook, payload):
+    headers = {'Content-Type': 'application/json'}
+    try:
+        response = requests.post(webhook, json=payload, headers=headers)
+        response.raise_for_status()
+        print("Data sent to Discord successfully.")
+    except requests.exceptions.RequestException as e:
+        print(f"Error sending to Discord: {e}")
+        if e.response is not None:
+            print(f"Response content: {e.response.content}")
+        print(payload)
+
+
+def dispatch_to_destinations(destinations, send):
+    # Call send(destination) for every destination at once
+    with ThreadPoolExecutor(max_workers=max(len(destinations), 1)) as executor:
+        list(executor.map(send, destinations))
+
+
+def dispatch(destinations, payloads):
+    # Send the payloads to every destination at once. Each destination receives its payloads in order.
+    def send(destination):
+        for payload in payloads:
+            push_to_discord(destination['Webhook'], get_destination_payload(payload, destination))
+
+    dispatch_to_destinations(destinations, send)
@@ -0,0 +1,92 @@
+import requests
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Get the directory where the script is located
+script_directory = os.path.dirname(os.path.abspath(__file__))
+http_cache_directory = os.path.join(script_directory, 'HttpCache')
+http_cache_days = 30
+
+# The cache is pruned once per run, by the first of the concurrent requests
+prune_state = {'pruned': False}
+prune_lock = threading.Lock()
+
+
+def get_cache_path(url):
+    # Each response is stored in its own file, keyed on the full URL
+    return os.path.join(http_cache_directory, f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.json")
+
+
+def prune_http_cache():
+    # Remove responses that have not been requested recently
+    oldest_use = time.time() - http_cache_days * 86400
+    for file_name in os.listdir(http_cache_directory):
+        # Temporary files belong to responses that are still being written
+        if file_name.endswith('.tmp'):
+            continue
+        file_path = os.path.join(http_cache_directory, file_name)
+        try:
+            if os.path.getmtime(file_path) < oldest_use:
+                os.remove(file_path)
+        except FileNotFoundError:
+            # Replaced or removed by another request while pruning
+            continue
+
+
+def get_revalidated_json(url, validators=None, params=None, headers=None, timeout=None):
+    # GET a JSON response, sending If-None-Match/If-Modified-Since from the validators of a copy the caller keeps.
+    # Returns (body, validators). The body is None if the server answered 304, meaning the caller's copy is current.
+    request_headers = dict(headers or {})
+    if validators:
+        if validators.get('etag'):
+            request_headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            request_headers['If-Modified-Since'] = validators['last_modified']
+
+    response = requests.get(url, params=params, headers=request_headers, timeout=timeout)
+    if response.status_code == 304 and validators:
+        return None, validators
+
+    body = response.json()
+    if response.status_code != 200:
+        return body, None
+    return body, {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+
+def get_json(url, params=None, headers=None, timeout=None):
+    # GET a JSON response, revalidating a stored copy with If-None-Match/If-Modified-Since.
+    # A 304 is answered from the stored copy, so an unchanged response costs a round trip instead of a download.
+    # Only successful responses with an ETag or Last-Modified header are stored.
+    os.makedirs(http_cache_directory, exist_ok=True)
+    with prune_lock:
+        if not prune_state['pruned']:
+            prune_state['pruned'] = True
+            prune_http_cache()
+
+    full_url = requests.Request('GET', url, params=params).prepare().url
+    cache_path = get_cache_path(full_url)
+    cached_response = None
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r') as cache_file:
+                cached_response = json.load(cache_file)
+        except (OSError, ValueError):
+            cached_response = None
+
+    cached_validators = cached_response.get('validators') if cached_response is not None else None
+    body, validators = get_revalidated_json(full_url, cached_validators, headers=headers, timeout=timeout)
+    if body is None:
+        os.utime(cache_path)
+        return cached_response['body']
+
+    if validators and (validators['etag'] or validators['last_modified']):
+        cached_response = {'validators': validators, 'body': body}
+        # Write to a temporary file first so a concurrent request never reads a partial response
+        temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as cache_file:
+            json.dump(cached_response, cache_file)
+        os.replace(temp_path, cache_path)
+    return body
@@ -0,0 +1,99 @@
+import requests
+import codecs
+import json
+
+# Bytes read from the socket at a time while streaming a response
+chunk_size = 64 * 1024
+whitespace = ' \t\n\r'
+
+
+def iter_json_array(chunks, path):
+    # Yield the elements of the array found under path (a list of object keys) as the JSON text arrives in chunks.
+    # Only the current chunk and the element being parsed are held in memory. Everything outside the path is skipped.
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    state = {'buffer': '', 'position': 0, 'finished': False}
+
+    def read_more():
+        # Drop what has already been parsed and append the next chunk. Returns False at the end of the stream.
+        if state['finished']:
+            return False
+        state['buffer'] = state['buffer'][state['position']:]
+        state['position'] = 0
+        try:
+            state['buffer'] += next(chunks)
+        except StopIteration:
+            state['finished'] = True
+        return True
+
+    def next_char(separators=whitespace):
+        # Skip over separators and return the next character without consuming it, or None at the end of the stream
+        while True:
+            buffer, position = state['buffer'], state['position']
+            while position < len(buffer) and buffer[position] in separators:
+                position += 1
+            state['position'] = position
+            if position < len(buffer):
+                return buffer[position]
+            if not read_more():
+                return None
+
+    def expect(char):
+        if next_char() != char:
+            raise ValueError(f"Expected '{char}' at position {state['position']} of the JSON stream.")
+        state['position'] += 1
+
+    def read_value():
+        # Decode the next complete value. A value that ends with the buffer may be cut short (e.g. a number), so it is
+        # only accepted once more text follows it or the stream has ended.
+        next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(state['buffer'], state['position'])
+                if end < len(state['buffer']) or state['finished']:
+                    state['position'] = end
+                    return value
+            except json.JSONDecodeError:
+                if state['finished']:
+                    raise
+            read_more()
+
+    # Walk down the objects along the path, skipping the members that are not on it
+    expect('{')
+    depth = 0
+    while depth < len(path):
+        char = next_char(whitespace + ',')
+        if char is None or char == '}':
+            return
+        key = read_value()
+        expect(':')
+        if key != path[depth]:
+            read_value()
+            continue
+        depth += 1
+        expect('[' if depth == len(path) else '{')
+
+    # Hand out the array elements one at a time
+    while True:
+        char = next_char(whitespace + ',')
+        if char is None or char == ']':
+            return
+        yield read_value()
+
+
+def iter_response_rows(response, path):
+    # Stream the rows of a response requested with stream=True, decoding the bytes incrementally
+    text_decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    chunks = (text_decoder.decode(chunk) for chunk in response.iter_content(chunk_size))
+    try:
+        yield from iter_json_array(chunks, path)
+    finally:
+        response.close()
+
+
+def get_tautulli_rows(tautulli, params):
+    # Yield the rows of a Tautulli command that returns a table (response.data.data) without loading the whole response
+    response = requests.get(f"{tautulli['Url']}/api/v2", params=dict(params, apikey=tautulli['APIKey']),
+                            timeout=tautulli['Timeout'], stream=True)
+    response.raise_for_status()
+    yield from iter_response_rows(response, ['response', 'data', 'data'])
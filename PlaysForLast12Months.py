@@ -0,0 +1,140 @@
+import requests
+import json
+import os
+from datetime import datetime
+from ChartRenderer import dispatch_charts, render_bar_chart
+from DiscordPayloads import dispatch, format_code_block, get_destinations, pack_code_blocks
+from Servers import fan_out, get_clients
+
+# Get the directory where the script is located
+script_directory = os.path.dirname(os.path.abspath(__file__))
+config_path = os.path.join(script_directory, 'config.json')
+play_cache_path = os.path.join(script_directory, 'PlayStatsCache.json')
+month_count = 12
+
+
+# Load configuration from the config.json file
+def load_config():
+    with open(config_path, 'r') as config_file:
+        return json.load(config_file)
+
+
+def load_play_cache():
+    # Maps each server name to {'YYYY-MM': plays per media type} for every month that has already ended
+    if not os.path.exists(play_cache_path):
+        return {}
+    with open(play_cache_path, 'r') as cache_file:
+        return json.load(cache_file)
+
+
+def save_play_cache(play_cache):
+    with open(play_cache_path, 'w') as cache_file:
+        json.dump(play_cache, cache_file)
+
+
+def get_last_months(now, count):
+    # 'YYYY-MM' keys for the last <count> months, oldest first, ending with the current month
+    months = []
+    year, month = now.year, now.month
+    for _ in range(count):
+        months.append(f"{year}-{month:02}")
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return months[::-1]
+
+
+def get_plays_by_month(plays_per_month):
+    # Bucket the Tautulli series into {month: {media type: plays}} in a single pass over the months
+    media_types = [series['name'] for series in plays_per_month['series']]
+    columns = zip(*[series['data'] for series in plays_per_month['series']])
+    return {
+        datetime.strptime(category, '%b %Y').strftime('%Y-%m'): dict(zip(media_types, plays))
+        for category, plays in zip(plays_per_month['categories'], columns)
+    }
+
+
+def run(config, clients):
+    script_name = 'PlexPlayStats'
+    script_settings = config['ScriptSettings'][script_name]
+    destinations = get_destinations(script_settings)
+    media_types = script_settings['MediaTypes']
+    remove_months_with_zero_plays = script_settings['RemoveMonthsWithZeroPlays']
+    charts = script_settings.get('Charts', False)
+    tautulli_instances = clients['Tautulli']
+
+    months = get_last_months(datetime.now(), month_count)
+    current_month = months[-1]
+    play_cache = load_play_cache()
+
+    def get_server_plays_by_month(tautulli):
+        # Months that have ended never change, so only the current month is requested when the rest are cached
+        server_cache = play_cache.get(tautulli['Name'], {})
+        time_range = 1 if all(month in server_cache for month in months[:-1]) else month_count
+        response = requests.get(f"{tautulli['Url']}/api/v2", params={
+            'apikey': tautulli['APIKey'], 'cmd': 'get_plays_per_month', 'time_range': time_range, 'y_axis': 'plays'},
+            timeout=tautulli['Timeout'])
+        server_plays = get_plays_by_month(response.json()['response']['data'])
+
+        # Cache the months that have ended, keeping only the ones still needed
+        server_cache.update({month: plays for month, plays in server_plays.items() if month != current_month})
+        server_cache = {month: server_cache[month] for month in months[:-1] if month in server_cache}
+        server_cache[current_month] = server_plays.get(current_month, {})
+        return server_cache
+
+    # Get the plays of every Tautulli server at once and sum them per month and media type
+    server_plays_by_month = fan_out(tautulli_instances, get_server_plays_by_month)
+    if not server_plays_by_month:
+        payload = {
+            'content': '**Could not get plays from Tautulli.**\nSee the script output for the error messages.'
+        }
+        dispatch(destinations, [payload])
+        return
+    plays_by_month = {}
+    for tautulli, server_plays in server_plays_by_month:
+        play_cache[tautulli['Name']] = {month: plays for month, plays in server_plays.items() if month != current_month}
+        for month, plays in server_plays.items():
+            month_plays = plays_by_month.setdefault(month, {})
+            for media_type, media_type_plays in plays.items():
+                month_plays[media_type] = month_plays.get(media_type, 0) + media_type_plays
+    # Drop servers that are no longer configured
+    save_play_cache({tautulli['Name']: play_cache[tautulli['Name']] for tautulli in tautulli_instances if tautulli['Name'] in play_cache})
+
+    # Build the table rows
+    rows = []
+    for month in months:
+        plays = plays_by_month.get(month, {})
+        row = [datetime.strptime(month, '%Y-%m').strftime('%b %Y')] + [str(plays.get(media_type, 0)) for media_type in media_types]
+        if remove_months_with_zero_plays and all(plays.get(media_type, 0) == 0 for media_type in media_types):
+            continue
+        rows.append(row)
+
+    if not rows:
+        print('No plays to report.')
+        return
+
+    # Render the plays as a chart if enabled, falling back to text if it cannot be rendered
+    if charts:
+        chart_path = render_bar_chart(f"Plays for the last {month_count} Months", [row[0] for row in rows],
+                                      {media_type: [int(row[index + 1]) for row in rows] for index, media_type in enumerate(media_types)},
+                                      stacked=True)
+        if chart_path:
+            dispatch_charts(destinations, [chart_path], f"**Plays for the last {month_count} Months!**")
+            return
+
+    # Convert results to string and send to Discord
+    header = ['Month'] + media_types
+    column_widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    template = '\t'.join(['{:<{}}'] * len(header))
+    str_body = '\n'.join(template.format(*[value for pair in zip(row, column_widths) for value in pair])
+                         for row in [header] + rows)
+    section = format_code_block(f"**Plays for the last {month_count} Months!**", str_body)
+
+    dispatch(destinations, pack_code_blocks([section]))
+
+
+def main():
+    config = load_config()
+    run(config, get_clients(config))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
-import requests
 import json
 from datetime import datetime
 import os
+from ChartRenderer import dispatch_charts, render_bar_chart
+from DiscordPayloads import dispatch, get_destinations, pack_embeds
+from HttpCache import get_json
+from JSONStream import get_tautulli_rows
+from Servers import fan_out, get_clients
 
 # Get the directory where the script is located
 script_directory = os.path.dirname(os.path.abspath(__file__))
@@ -12,59 +16,62 @@ def load_config():
     with open(config_path, 'r') as config_file:
         return json.load(config_file)
 
-def main():
-    config = load_config()
+def run(config, clients):
     script_name = 'PlexLibraryStats'
     script_settings = config['ScriptSettings'][script_name]
-    discord_webhook = script_settings['Webhook']
+    destinations = get_destinations(script_settings)
     excluded_libraries = script_settings['ExcludedLibraries']
-    tautulli_url = config['Tautulli']['Url']
-    tautulli_api_key = config['Tautulli']['APIKey']
-    
-    # Function to send data to Discord webhook
-    def push_to_discord(payload):
-        headers = {'Content-Type': 'application/json'}
-        try:
-            response = requests.post(discord_webhook, data=json.dumps(payload), headers=headers)
-            response.raise_for_status()
-            response.cookies
-            print("Data sent to Discord successfully.")
-        except requests.exceptions.RequestException as e:
-            print(f"Error sending to Discord: {e}")
-            print(f"Response content: {response.content}")
-            print(payload)
+    charts = script_settings.get('Charts', False)
+    tautulli_instances = clients['Tautulli']
     
     # Function to get library stats
-    def get_library_stats(section_id):
-        library_url = f"{tautulli_url}/api/v2?apikey={tautulli_api_key}&cmd=get_library_media_info&section_id={section_id}"
-        response = requests.get(library_url)
-        data = response.json()['response']['data']
-        total_size_bytes = data['total_file_size']
-        
-        if total_size_bytes >= 1000000000000:
-            size_format = 'Tb'
-            formatted_size = round(total_size_bytes / 1e12, 2)
-        else:
-            size_format = 'Gb'
-            formatted_size = round(total_size_bytes / 1e9, 2)
-        
+    def get_library_stats(tautulli, section_id):
+        library_url = f"{tautulli['Url']}/api/v2?apikey={tautulli['APIKey']}&cmd=get_library_media_info&section_id={section_id}"
+        # Unchanged libraries are answered from the local copy when Tautulli can revalidate them
+        data = get_json(library_url, timeout=tautulli['Timeout'])['response']['data']
         return {
-            'Size': formatted_size,
-            'Format': size_format,
+            'SizeBytes': data['total_file_size'],
         }
     
-    # Get library data from Tautulli
-    libraries_table_url = f"{tautulli_url}/api/v2?apikey={tautulli_api_key}&cmd=get_libraries_table"
-    response = requests.get(libraries_table_url)
-    libraries_data = response.json()['response']['data']['data']
+    # Get library data from a single Tautulli server
+    def get_server_libraries(tautulli):
+        # The table rows are parsed as they arrive, so only the current row is held in memory
+        server_libraries = []
+        for library in get_tautulli_rows(tautulli, {'cmd': 'get_libraries_table'}):
+            # Filter out excluded libraries
+            if library['section_name'] not in excluded_libraries:
+                stats = get_library_stats(tautulli, library['section_id'])
+                stats.update({'Library': library['section_name'], 'Type': library['section_type'], 'Count': library['count'], 'SeasonAlbumCount': library['parent_count'], 'EpisodeTrackCount': library['child_count']})
+                server_libraries.append(stats)
+        return server_libraries
     
-    # Filter out excluded libraries
+    # Get library data from every Tautulli server at once, summing libraries with the same name and type
     libraries_stats = []
-    for library in libraries_data:
-        if library['section_name'] not in excluded_libraries:
-            stats = get_library_stats(library['section_id'])
-            stats.update({'Library': library['section_name'], 'Type': library['section_type'], 'Count': library['count'], 'SeasonAlbumCount': library['parent_count'], 'EpisodeTrackCount': library['child_count']})
-            libraries_stats.append(stats)
+    merged_libraries = {}
+    for _, server_libraries in fan_out(tautulli_instances, get_server_libraries):
+        for stats in server_libraries:
+            library_key = (stats['Library'], stats['Type'])
+            if library_key not in merged_libraries:
+                merged_libraries[library_key] = {'Library': stats['Library'], 'Type': stats['Type'], 'SizeBytes': 0, 'Count': 0, 'SeasonAlbumCount': 0, 'EpisodeTrackCount': 0}
+                libraries_stats.append(merged_libraries[library_key])
+            for stat_name in ['SizeBytes', 'Count', 'SeasonAlbumCount', 'EpisodeTrackCount']:
+                merged_libraries[library_key][stat_name] += int(stats[stat_name] or 0)
+    
+    for stats in libraries_stats:
+        if stats['SizeBytes'] >= 1000000000000:
+            stats['Format'] = 'Tb'
+            stats['Size'] = round(stats['SizeBytes'] / 1e12, 2)
+        else:
+            stats['Format'] = 'Gb'
+            stats['Size'] = round(stats['SizeBytes'] / 1e9, 2)
+    
+    # Render the library sizes as a chart if enabled, falling back to embeds if it cannot be rendered
+    if charts and libraries_stats:
+        chart_path = render_bar_chart('Library Sizes (GB)', [lib['Library'] for lib in libraries_stats],
+                                      {'Size': [round(lib['SizeBytes'] / 1e9, 2) for lib in libraries_stats]}, horizontal=True)
+        if chart_path:
+            dispatch_charts(destinations, [chart_path], '**Plex Library Stats**')
+            return
     
     # Group libraries by type (Movie, TV, Music) and format data for Discord payload
     discord_payload = []
@@ -105,8 +112,11 @@ def main():
     
     # Send data to Discord webhook
     if discord_payload:
-        payload = {'embeds': discord_payload}
-        push_to_discord(payload)
+        dispatch(destinations, pack_embeds(discord_payload))
+
+def main():
+    config = load_config()
+    run(config, get_clients(config))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -3,6 +3,9 @@ import json
 import unicodedata
 from datetime import datetime
 import os
+from DiscordPayloads import dispatch, get_destinations, pack_embeds
+from Servers import fan_out, get_clients, get_server_stats_count
+from TMDBMetadata import get_indexed_guids, get_thumb_updated_at, get_tmdb_info, is_store_modified, load_metadata_store, save_metadata_store, set_indexed_guids
 
 # Get the directory where the script is located
 script_directory = os.path.dirname(os.path.abspath(__file__))
@@ -13,53 +16,33 @@ def load_config():
     with open(config_path, 'r') as config_file:
         return json.load(config_file)
 
-def main():
-    def get_tmdb_info(tmdb_api_key, tautulli_url, tautulli_api_key, media_type, title=None, year=None, rating_key=None):
-        tmdb_id = None
+def run(config, clients):
+    def get_media_tmdb_info(tmdb_api_key, tautulli, media_type, title=None, year=None, rating_key=None, thumb=None):
+        guids = []
         
-        # Try to get TMDB ID from Tautulli if rating_key is provided
         if rating_key:
-            tautulli_params = {
-                "apikey": tautulli_api_key,
-                "cmd": "get_metadata",
-                "rating_key": rating_key
-            }
-            
-            tautulli_response = requests.get(f"{tautulli_url}/api/v2", params=tautulli_params)
+            # Use the indexed GUIDs unless Plex has refreshed the item since it was indexed
+            guids = get_indexed_guids(tmdb_store, tautulli['Name'], rating_key, get_thumb_updated_at(thumb))
             
-            if tautulli_response.status_code == 200:
-                tautulli_data = tautulli_response.json()
-                if tautulli_data["response"]["data"]:
-                    # Look for the TMDB GUID in the list of GUIDs
-                    tmdb_guid = next((guid for guid in tautulli_data["response"]["data"]["guids"] if guid.startswith("tmdb://")), None)
-                    if tmdb_guid:
-                        # Extract the TMDB ID from the TMDB GUID
-                        tmdb_id = tmdb_guid.split("tmdb://")[1]
-        
-        # If TMDB ID found in Tautulli, use it to lookup the media information
-        if tmdb_id:
-            media_url = f"https://api.themoviedb.org/3/{media_type}/{tmdb_id}?api_key={tmdb_api_key}&language=en-US"
-            media_results = requests.get(media_url).json()
-            if "success" in media_results and media_results["success"] is False:
-                # If TMDB ID lookup returns no data, return None
-                return None
-            return media_results
-        # No TMDB ID, so will will attempt to search TMDB for the media information
-        else:
-            tmdb_url = f"https://api.themoviedb.org/3/search/{media_type}?api_key={tmdb_api_key}&language=en-US&page=1&include_adult=false&query={title}"
-            if year is not None and year != '':
-                tmdb_url += f"&year={year}"
-            
-            tmdb_results = requests.get(tmdb_url).json()
-            # Check if 'results' key exists and the list is not empty
-            if 'results' in tmdb_results and len(tmdb_results['results']) > 0:
-                # Get the first TMDB ID from the search results
-                media_id = tmdb_results['results'][0]['id']
-                media_url = f"https://api.themoviedb.org/3/{media_type}/{media_id}?api_key={tmdb_api_key}&language=en-US"
-                media_results = requests.get(media_url).json()
-                return media_results
+            # Otherwise get the GUIDs from Tautulli and index them
+            if guids is None:
+                guids = []
+                tautulli_params = {
+                    "apikey": tautulli['APIKey'],
+                    "cmd": "get_metadata",
+                    "rating_key": rating_key
+                }
+                
+                tautulli_response = requests.get(f"{tautulli['Url']}/api/v2", params=tautulli_params, timeout=tautulli['Timeout'])
+                
+                if tautulli_response.status_code == 200:
+                    tautulli_data = tautulli_response.json()
+                    if tautulli_data["response"]["data"]:
+                        guids = tautulli_data["response"]["data"]["guids"]
+                        set_indexed_guids(tmdb_store, tautulli['Name'], rating_key, guids, tautulli_data["response"]["data"].get("updated_at"))
         
-        return None
+        # Read from the local TMDB store first, falling back to TMDB on a miss
+        return get_tmdb_info(tmdb_api_key, media_type, title=title, year=year, store=tmdb_store, guids=guids)
     
     def get_sanitized_string(input_string):
         # Replace any non-ASCII characters with their closest ASCII representation
@@ -72,49 +55,61 @@ def main():
         
         return normalized_string
     
-    def push_to_discord(discord_webhook, payload):
-        headers = {'Content-Type': 'application/json'}
-        try:
-            response = requests.post(discord_webhook, json=payload, headers=headers)
-            response.raise_for_status()
-            print("Data sent to Discord successfully.")
-        except requests.exceptions.RequestException as e:
-            print(f"Error sending to Discord: {e}")
-            print(f"Response content: {response.content}")
-            print(payload)
-    
-    # Parse the config file and assign variables
-    config = load_config()
+    # Assign variables from the config
     script_name = 'PopularOnPlex'
     script_settings = config['ScriptSettings'][script_name]
-    discord_webhook = script_settings['Webhook']
+    destinations = get_destinations(script_settings)
     count = script_settings['Count']
     days = script_settings['Days']
-    tautulli_url = config['Tautulli']['Url']
-    tautulli_api_key = config['Tautulli']['APIKey']
+    tautulli_instances = clients['Tautulli']
+    # Rows are cut to the top <count> after the servers are merged
+    stats_count = get_server_stats_count(count, tautulli_instances)
     tmdb_api_key = config['TMDB']['APIKey']
+    tmdb_store = load_metadata_store()
     
-    response = requests.get(f"{tautulli_url}/api/v2", params={"apikey": tautulli_api_key, "cmd": "get_server_info"})
-    plex_server_identifier = response.json()["response"]["data"]["pms_identifier"]
+    def get_server_popular(tautulli):
+        # Get the popular movies and shows of a single server
+        tautulli_params = {"apikey": tautulli['APIKey']}
+        response = requests.get(f"{tautulli['Url']}/api/v2", params=dict(tautulli_params, cmd="get_server_info"), timeout=tautulli['Timeout'])
+        plex_server_identifier = response.json()["response"]["data"]["pms_identifier"]
+        
+        response = requests.get(f"{tautulli['Url']}/api/v2", params=dict(tautulli_params, cmd="get_home_stats", grouping=1, time_range=days, stats_count=stats_count), timeout=tautulli['Timeout'])
+        data = response.json()["response"]["data"]
+        
+        # Find the sections for "popular_movies" and "popular_tv"
+        sections = {}
+        for item in data:
+            for row in item["rows"]:
+                row["plex_server_identifier"] = plex_server_identifier
+                row["tautulli"] = tautulli
+            sections[item["stat_id"]] = item["rows"]
+        return sections
     
-    response = requests.get(f"{tautulli_url}/api/v2", params={"apikey": tautulli_api_key, "cmd": "get_home_stats", "grouping": 1, "time_range": days, "stats_count": count})
-    data = response.json()["response"]["data"]
+    def merge_popular(stat_id):
+        # Merge the same title from several servers, summing the users that watched it, and keep the most watched
+        merged_rows = {}
+        for _, sections in server_sections:
+            for row in sections.get(stat_id, []):
+                row_key = (row["title"], row["year"])
+                if row_key in merged_rows:
+                    merged_rows[row_key]["users_watched"] += row["users_watched"]
+                else:
+                    merged_rows[row_key] = dict(row)
+        return sorted(merged_rows.values(), key=lambda row: row["users_watched"], reverse=True)[:count]
     
-    # Find the sections for "popular_movies" and "popular_tv"
-    sections = {}
-    for item in data:
-        sections[item["stat_id"]] = item["rows"]
+    # Get the popular movies and shows from every Tautulli server at once
+    server_sections = fan_out(tautulli_instances, get_server_popular)
     
     # Get the lists for "popular_movies" and "popular_tv" or set to empty lists if not found
-    top_movies = sections.get("popular_movies", [])
-    top_tv_shows = sections.get("popular_tv", [])
+    top_movies = merge_popular("popular_movies")
+    top_tv_shows = merge_popular("popular_tv")
     
     top_movies_embed = []
     top_tv_shows_embed = []
     
     for movie in top_movies:
         sanitized_title = get_sanitized_string(movie["title"])
-        tmdb_movie_results = get_tmdb_info(tmdb_api_key, tautulli_url, tautulli_api_key, media_type="movie", title=sanitized_title, year=movie["year"], rating_key=movie["rating_key"])
+        tmdb_movie_results = get_media_tmdb_info(tmdb_api_key, movie["tautulli"], media_type="movie", title=sanitized_title, year=movie["year"], rating_key=movie["rating_key"], thumb=movie.get("thumb"))
         
         if tmdb_movie_results:
             movie_embed_params = {
@@ -123,7 +118,7 @@ def main():
                 "url": f"https://www.themoviedb.org/movie/{tmdb_movie_results['id']}",
                 "author": {
                     "name": "Open on Plex",
-                    "url": f"https://app.plex.tv/desktop/#!/server/{plex_server_identifier}/details?key=%2Flibrary%2Fmetadata%2F{movie['rating_key']}",
+                    "url": f"https://app.plex.tv/desktop/#!/server/{movie['plex_server_identifier']}/details?key=%2Flibrary%2Fmetadata%2F{movie['rating_key']}",
                     "icon_url": "https://i.imgur.com/FNoiYXP.png"
                 },
                 "description": get_sanitized_string(tmdb_movie_results["overview"]),
@@ -143,7 +138,7 @@ def main():
                 "url": "https://www.themoviedb.org/movie/",
                 "author": {
                     "name": "Open on Plex",
-                    "url": f"https://app.plex.tv/desktop/#!/server/{plex_server_identifier}/details?key=%2Flibrary%2Fmetadata%2F{movie['rating_key']}",
+                    "url": f"https://app.plex.tv/desktop/#!/server/{movie['plex_server_identifier']}/details?key=%2Flibrary%2Fmetadata%2F{movie['rating_key']}",
                     "icon_url": "https://i.imgur.com/FNoiYXP.png"
                 },
                 "description": "Unknown",
@@ -161,7 +156,7 @@ def main():
     
     for show in top_tv_shows:
         sanitized_title = get_sanitized_string(show["title"])
-        tmdb_tv_results = get_tmdb_info(tmdb_api_key, tautulli_url, tautulli_api_key, "tv", sanitized_title, show["year"], show["rating_key"])
+        tmdb_tv_results = get_media_tmdb_info(tmdb_api_key, show["tautulli"], "tv", sanitized_title, show["year"], show["rating_key"], show.get("thumb"))
         
         if tmdb_tv_results:
             # Check for the existence of 'episode_run_time'
@@ -176,7 +171,7 @@ def main():
                 "url": f"https://www.themoviedb.org/tv/{tmdb_tv_results['id']}",
                 "author": {
                     "name": "Open on Plex",
-                    "url": f"https://app.plex.tv/desktop/#!/server/{plex_server_identifier}/details?key=%2Flibrary%2Fmetadata%2F{show['rating_key']}",
+                    "url": f"https://app.plex.tv/desktop/#!/server/{show['plex_server_identifier']}/details?key=%2Flibrary%2Fmetadata%2F{show['rating_key']}",
                     "icon_url": "https://i.imgur.com/FNoiYXP.png"
                 },
                 "description": get_sanitized_string(tmdb_tv_results["overview"]),
@@ -196,7 +191,7 @@ def main():
                 "title": sanitized_title,
                 "author": {
                     "name": "Open on Plex",
-                    "url": f"https://app.plex.tv/desktop/#!/server/{plex_server_identifier}/details?key=%2Flibrary%2Fmetadata%2F{show['rating_key']}",
+                    "url": f"https://app.plex.tv/desktop/#!/server/{show['plex_server_identifier']}/details?key=%2Flibrary%2Fmetadata%2F{show['rating_key']}",
                     "icon_url": "https://i.imgur.com/FNoiYXP.png"
                 },
                 "description": "Unknown",
@@ -212,21 +207,19 @@ def main():
         
         top_tv_shows_embed.append(tv_show_embed_params)
     
-    movies_payload = {
-        "username": "Popular on Plex",
-        "content": "**Popular Movies on Plex:**",
-        "embeds": top_movies_embed
-    }
-    
-    push_to_discord(discord_webhook, movies_payload)
+    # Keep anything that had to be fetched for the next run
+    if is_store_modified(tmdb_store):
+        save_metadata_store(tmdb_store)
     
-    shows_payload = {
-        "username": "Popular on Plex",
-        "content": "**Popular TV Shows on Plex:**",
-        "embeds": top_tv_shows_embed
-    }
+    movies_payloads = pack_embeds(top_movies_embed, username="Popular on Plex", content="**Popular Movies on Plex:**")
+    shows_payloads = pack_embeds(top_tv_shows_embed, username="Popular on Plex", content="**Popular TV Shows on Plex:**")
     
-    push_to_discord(discord_webhook, shows_payload)
+    dispatch(destinations, movies_payloads + shows_payloads)
+
+
+def main():
+    config = load_config()
+    run(config, get_clients(config))
 
 # Call the main function
 if __name__ == "__main__":
@@ -1,59 +1,239 @@
 import requests
 import json
 import os
+from array import array
 from datetime import datetime
+from DiscordPayloads import dispatch, get_destinations, pack_embeds
+from Servers import fan_out, get_clients
 
-def main():
-    def load_config():
-        with open(config_path, 'r') as config_file:
-            return json.load(config_file)
+# Get the directory where the script is located
+script_directory = os.path.dirname(os.path.abspath(__file__))
+config_path = os.path.join(script_directory, 'config.json')
+
+# Layout of the throughput history. A fixed header holds the state of the last run, followed by a
+# fixed number of samples which are overwritten oldest first.
+NEXT_INDEX = 0
+SAMPLE_COUNT = 1
+LAST_PAUSED = 2
+LAST_SLOT_COUNT = 3
+POSTED_SPEED = 4
+# Projected finish time (timestamp) of the last post
+POSTED_ETA = 5
+LAST_LOW_DISK = 6
+LAST_STALLED = 7
+HEADER_LENGTH = 8
+# Each sample is (timestamp, speed in KB/s, remaining MB, free disk space in GB)
+SAMPLE_LENGTH = 4
+
+def load_history(history_path, history_size):
+    history = array('d')
+    if os.path.exists(history_path):
+        with open(history_path, 'rb') as history_file:
+            history_bytes = history_file.read()
+        # A damaged file is not a whole number of samples, so it is replaced below like a missing one
+        if len(history_bytes) % history.itemsize == 0:
+            history.frombytes(history_bytes)
     
-    def push_to_discord(discord_webhook, payload):
-        headers = {'Content-Type': 'application/json'}
-        try:
-            response = requests.post(discord_webhook, json=payload, headers=headers)
-            response.raise_for_status()
-            print("Data sent to Discord successfully.")
-        except requests.exceptions.RequestException as e:
-            print(f"Error sending to Discord: {e}")
-            print(f"Response content: {response.content}")
-            print(payload)
+    # Start a new history if there is none yet, it is damaged, or the configured size has changed
+    if len(history) != HEADER_LENGTH + history_size * SAMPLE_LENGTH:
+        history = array('d', [0.0] * (HEADER_LENGTH + history_size * SAMPLE_LENGTH))
+        for index in [LAST_PAUSED, LAST_SLOT_COUNT, POSTED_SPEED, POSTED_ETA]:
+            history[index] = -1
     
-    # Get the directory where the script is located
-    script_directory = os.path.dirname(os.path.abspath(__file__))
-    config_path = os.path.join(script_directory, 'config.json')
-    log_file_path = os.path.join(script_directory, 'SABLog.txt')
+    return history
+
+def save_history(history_path, history):
+    # Write to a temporary file first so an interrupted write never leaves a truncated history
+    temp_path = f"{history_path}.tmp"
+    with open(temp_path, 'wb') as history_file:
+        history.tofile(history_file)
+    os.replace(temp_path, history_path)
+
+def append_sample(history, sample):
+    capacity = (len(history) - HEADER_LENGTH) // SAMPLE_LENGTH
+    next_index = int(history[NEXT_INDEX])
+    offset = HEADER_LENGTH + next_index * SAMPLE_LENGTH
+    history[offset:offset + SAMPLE_LENGTH] = array('d', sample)
+    history[NEXT_INDEX] = (next_index + 1) % capacity
+    history[SAMPLE_COUNT] = min(int(history[SAMPLE_COUNT]) + 1, capacity)
+
+def get_samples(history):
+    # Return the samples ordered from oldest to newest
+    capacity = (len(history) - HEADER_LENGTH) // SAMPLE_LENGTH
+    sample_count = int(history[SAMPLE_COUNT])
+    first_index = (int(history[NEXT_INDEX]) - sample_count) % capacity
+    samples = []
+    for i in range(sample_count):
+        offset = HEADER_LENGTH + ((first_index + i) % capacity) * SAMPLE_LENGTH
+        samples.append(tuple(history[offset:offset + SAMPLE_LENGTH]))
+    return samples
+
+def get_smoothed_speed(samples, smoothing=0.3):
+    # Exponentially weighted moving average of the download speed, newest samples weigh the most
+    smoothed_speed = None
+    for sample in samples:
+        speed = sample[1]
+        smoothed_speed = speed if smoothed_speed is None else smoothing * speed + (1 - smoothing) * smoothed_speed
+    return smoothed_speed or 0.0
+
+def get_speed_trend(samples):
+    # Compare the average speed of the newest half of the samples to the oldest half
+    if len(samples) < 4:
+        return 'Steady'
+    half = len(samples) // 2
+    older_speed = sum(sample[1] for sample in samples[:half]) / half
+    newer_speed = sum(sample[1] for sample in samples[-half:]) / half
+    if newer_speed > older_speed * 1.1:
+        return 'Rising'
+    if newer_speed < older_speed * 0.9:
+        return 'Falling'
+    return 'Steady'
+
+def is_stalled(samples, window):
+    # Downloads are stalled if nothing has been downloaded across the last few samples
+    if len(samples) < window:
+        return False
+    recent_samples = samples[-window:]
+    return recent_samples[-1][2] > 0 and all(sample[2] == recent_samples[0][2] for sample in recent_samples)
+
+def get_percent_change(old_value, new_value):
+    if old_value <= 0:
+        return 0 if new_value <= 0 else 100
+    return abs(new_value - old_value) / old_value * 100
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+def merge_queues(sabnzbd_queues):
+    # Combine the queues of several SABnzbd servers into one queue with the same fields
+    if len(sabnzbd_queues) == 1:
+        return sabnzbd_queues[0]
     
-    # Load configuration from the config.json file
-    config = load_config()
+    paused_queue = next((sabnzbd_queue for sabnzbd_queue in sabnzbd_queues if sabnzbd_queue['paused']), None)
+    # Report the disk space of the server with the least free space
+    disk_queue = min(sabnzbd_queues, key=lambda sabnzbd_queue: float(sabnzbd_queue['diskspace1']))
+    kbpersec = sum(float(sabnzbd_queue['kbpersec']) for sabnzbd_queue in sabnzbd_queues)
+    mbleft = sum(float(sabnzbd_queue['mbleft']) for sabnzbd_queue in sabnzbd_queues)
+    
+    return {
+        'paused': paused_queue is not None,
+        'pause_int': paused_queue['pause_int'] if paused_queue else '0',
+        'noofslots': sum(int(sabnzbd_queue['noofslots']) for sabnzbd_queue in sabnzbd_queues),
+        'slots': [slot for sabnzbd_queue in sabnzbd_queues for slot in sabnzbd_queue['slots']],
+        'kbpersec': kbpersec,
+        'mbleft': mbleft,
+        'speed': f"{kbpersec / 1024:.1f} M" if kbpersec >= 1024 else f"{kbpersec:.0f} K",
+        'timeleft': format_seconds(mbleft * 1024 / kbpersec) if kbpersec > 0 else '0:00:00',
+        'diskspace1': disk_queue['diskspace1'],
+        'diskspacetotal1': disk_queue['diskspacetotal1']
+    }
+
+# Load configuration from the config.json file
+def load_config():
+    with open(config_path, 'r') as config_file:
+        return json.load(config_file)
+
+def run(config, clients):
+    def get_sabnzbd_queue(sabnzbd, start, limit):
+        # Only the requested page of slots is returned, so the response size does not depend on the queue length
+        params = {'apikey': sabnzbd['APIKey'], 'output': 'json', 'mode': 'queue', 'start': start, 'limit': limit}
+        response = requests.get(f"{sabnzbd['Url']}/api", params=params, timeout=sabnzbd['Timeout'])
+        return response.json()['queue']
+    
+    def get_server_queue(sabnzbd):
+        # Lightweight status fetch for the paused/speed/disk fields and the total slot count.
+        # SABnzbd treats limit=0 as no limit, so ask for a single slot.
+        sabnzbd_queue = get_sabnzbd_queue(sabnzbd, 0, 1)
+        
+        # Only fetch the slots that will actually be rendered. The status fetch already holds the first slot.
+        if not sabnzbd_queue['paused'] and int(sabnzbd_queue['noofslots']) > 1:
+            sabnzbd_queue['slots'] = get_sabnzbd_queue(sabnzbd, 0, max_slots)['slots']
+        return sabnzbd_queue
+    
+    history_path = os.path.join(script_directory, 'SABHistory.bin')
+    
+    # Assign variables from the config
     script_name = 'SABnzbdStatus'
-    discord_webhook = config['ScriptSettings'][script_name]['Webhook']
-    sabnzbd_url = config['SABnzbd']['Url']
-    sabnzbd_api_key = config['SABnzbd']['APIKey']
+    script_settings = config['ScriptSettings'][script_name]
+    destinations = get_destinations(script_settings)
+    history_size = script_settings.get('HistorySize', 60)
+    speed_change_percent = script_settings.get('SpeedChangePercent', 50)
+    eta_change_percent = script_settings.get('EtaChangePercent', 25)
+    low_disk_space = script_settings.get('LowDiskSpaceGB', 50)
+    stalled_samples = script_settings.get('StalledSamples', 3)
+    sabnzbd_instances = clients['SABnzbd']
+    max_slots = 10
     
-    # Get SABnzbd queue information
-    try:
-        response = requests.get(f"{sabnzbd_url}/api?apikey={sabnzbd_api_key}&output=json&mode=queue")
-        sabnzbd_queue = response.json()['queue']
-    except Exception as e:
+    # Get SABnzbd queue information from every server at once
+    sabnzbd_queues = [sabnzbd_queue for _, sabnzbd_queue in fan_out(sabnzbd_instances, get_server_queue)]
+    if not sabnzbd_queues:
         payload = {
             'username': 'SABnzbdStatus',
-            'content': f'**Could not get SABnzbd queue information.**\nError message:\n{e}'
+            'content': '**Could not get SABnzbd queue information.**\nSee the script output for the error messages.'
         }
-        push_to_discord(discord_webhook, payload)
-        exit()
+        dispatch(destinations, [payload])
+        return
+    sabnzbd_queue = merge_queues(sabnzbd_queues)
+    slot_count = int(sabnzbd_queue['noofslots'])
+    
+    # Record this run in the throughput history
+    history = load_history(history_path, history_size)
+    paused = bool(sabnzbd_queue['paused'])
+    free_disk = float(sabnzbd_queue['diskspace1'])
+    sample_time = datetime.utcnow().timestamp()
+    append_sample(history, [sample_time, float(sabnzbd_queue['kbpersec']), float(sabnzbd_queue['mbleft']), free_disk])
+    samples = get_samples(history)
     
-    # Ensure the log file exists. If not, create it.
-    if not os.path.exists(log_file_path):
-        with open(log_file_path, 'w') as log_file:
-            log_file.write('-1')
+    smoothed_speed = get_smoothed_speed(samples)
+    speed_trend = get_speed_trend(samples)
+    smoothed_eta = float(sabnzbd_queue['mbleft']) * 1024 / smoothed_speed if smoothed_speed > 0 else -1
+    # The time remaining falls on every run, so compare when downloads are projected to finish instead
+    projected_finish = sample_time + smoothed_eta if smoothed_eta > 0 else -1
+    stalled = not paused and slot_count > 0 and is_stalled(samples, stalled_samples)
+    low_disk = free_disk < low_disk_space
     
-    # Get the last last_log_value and then update the file with the current
-    with open(log_file_path, 'r+') as log_file:
-        last_log_value = int(log_file.read())
-        log_file.seek(0)
-        log_file.truncate()
-        log_file.write(str(len(sabnzbd_queue['slots'])))
+    # Only post when something significant has changed since the last post
+    last_slot_count = int(history[LAST_SLOT_COUNT])
+    update_reasons = []
+    if last_slot_count == -1:
+        update_reasons.append('First run')
+    if history[LAST_PAUSED] != -1 and paused != bool(history[LAST_PAUSED]):
+        update_reasons.append('Downloads paused' if paused else 'Downloads resumed')
+    if slot_count < last_slot_count:
+        update_reasons.append('Download finished')
+    elif last_slot_count == 0 and slot_count > 0:
+        update_reasons.append('Download added')
+    if not paused and slot_count > 0:
+        if get_percent_change(history[POSTED_SPEED], smoothed_speed) >= speed_change_percent:
+            update_reasons.append('Speed changed')
+        # Post when the projected finish moves by more than EtaChangePercent of the time remaining
+        if smoothed_eta > 0 and (history[POSTED_ETA] <= 0 or abs(projected_finish - history[POSTED_ETA]) > smoothed_eta * eta_change_percent / 100):
+            update_reasons.append('Time remaining changed')
+    if stalled and not history[LAST_STALLED]:
+        update_reasons.append('Downloads stalled')
+    if low_disk and not history[LAST_LOW_DISK]:
+        update_reasons.append('Low disk space')
+    
+    history[LAST_PAUSED] = paused
+    history[LAST_SLOT_COUNT] = slot_count
+    history[LAST_STALLED] = stalled
+    history[LAST_LOW_DISK] = low_disk
+    if update_reasons:
+        history[POSTED_SPEED] = smoothed_speed
+        history[POSTED_ETA] = projected_finish
+    save_history(history_path, history)
+    
+    # Smoothed values and warnings shown alongside the SABnzbd status
+    notes = []
+    if smoothed_eta > 0:
+        notes.append(f"Smoothed time remaining: **{format_seconds(smoothed_eta)}** (speed {speed_trend.lower()})")
+    if stalled:
+        notes.append(f"**Downloads appear to be stalled.** Nothing was downloaded across the last {stalled_samples} checks.")
+    if low_disk:
+        notes.append(f"**Low disk space:** {sabnzbd_queue['diskspace1']}GB free.")
+    status_notes = ''.join(f"\n{note}" for note in notes)
     
     slot_embed = []
     if sabnzbd_queue['paused']:
@@ -75,13 +255,9 @@ def main():
             'timestamp': datetime.utcnow().isoformat()
         }
         slot_embed.append(embed_params)
-        payload = {
-            'username': 'Downloads Paused',
-            'content': f"Downloading **{len(sabnzbd_queue['slots'])}** item(s) at **{sabnzbd_queue['speed']}**Bs/second. Time remaining: **{sabnzbd_queue['timeleft']}**",
-            'embeds': slot_embed
-        }
-    elif len(sabnzbd_queue['slots']) > 0:
-        for slot in sabnzbd_queue['slots'][:10]:
+        payloads = pack_embeds(slot_embed, username='Downloads Paused', content=f"Downloading **{slot_count}** item(s) at **{sabnzbd_queue['speed']}**Bs/second. Time remaining: **{sabnzbd_queue['timeleft']}**{status_notes}")
+    elif slot_count > 0:
+        for slot in sabnzbd_queue['slots'][:max_slots]:
             embed_params = {
                 'color': 15197440,
                 'title': 'Filename',
@@ -97,11 +273,7 @@ def main():
             }
             slot_embed.append(embed_params)
         
-        payload = {
-            'username': 'First 10 Downloads',
-            'content': f"Downloading **{len(sabnzbd_queue['slots'])}** item(s) at **{sabnzbd_queue['speed']}**Bs/second. Time remaining: **{sabnzbd_queue['timeleft']}**",
-            'embeds': slot_embed
-        }
+        payloads = pack_embeds(slot_embed, username='First 10 Downloads', content=f"Downloading **{slot_count}** item(s) at **{sabnzbd_queue['speed']}**Bs/second. Time remaining: **{sabnzbd_queue['timeleft']}**{status_notes}")
     else:
         embed_params = {
             'color': 15197440,
@@ -116,17 +288,18 @@ def main():
             'timestamp': datetime.utcnow().isoformat()
         }
         slot_embed.append(embed_params)
-        payload = {
-            'username': 'No Downloads',
-            'content': 'Nothing currently in the download queue.',
-            'embeds': slot_embed
-        }
+        payloads = pack_embeds(slot_embed, username='No Downloads', content=f"Nothing currently in the download queue.{status_notes}")
     
-    if last_log_value == 0 and len(sabnzbd_queue['slots']) == 0:
-        # Log file and current slots are both 0. Do not update.
+    if not update_reasons:
         print('Nothing to update.')
     else:
-        push_to_discord(discord_webhook, payload)
+        print(f"Updating: {', '.join(update_reasons)}")
+        dispatch(destinations, payloads)
+
+
+def main():
+    config = load_config()
+    run(config, get_clients(config))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,63 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Seconds a single server is given to respond before its results are left out
+default_timeout = 30
+
+# Ranked stats summed across servers ask each server for this many times the reported count, so an item ranked
+# just below the cut on every server can still make the combined top
+merged_stats_factor = 5
+
+
+def get_instances(config, service):
+    # The Tautulli, Plex and SABnzbd sections can hold a single server or a list of servers.
+    # Every instance gets a Name (defaulting to its Url) and a Timeout.
+    instances = config.get(service, [])
+    if isinstance(instances, dict):
+        instances = [instances]
+    return [dict(instance, Name=instance.get('Name', instance['Url']), Timeout=instance.get('Timeout', default_timeout))
+            for instance in instances]
+
+
+def get_clients(config):
+    # The configured servers of every service, shared by all reports run in the same process
+    return {service: get_instances(config, service) for service in ['Tautulli', 'Plex', 'SABnzbd']}
+
+
+def get_server_stats_count(count, instances):
+    # The number of ranked rows to ask each server for when the top <count> is taken after merging
+    return count if len(instances) <= 1 else count * merged_stats_factor
+
+
+def get_matching_instance(instances, name):
+    # Find the instance with the given name, or the only instance if there is just one
+    matching_instance = next((instance for instance in instances if instance['Name'] == name), None)
+    if matching_instance is None and len(instances) == 1:
+        return instances[0]
+    return matching_instance
+
+
+def fan_out(instances, function):
+    # Call function(instance) for every instance concurrently and return [(instance, result)] in instance order.
+    # Instances that fail, or take longer than their Timeout, are reported and left out.
+    if not instances:
+        return []
+
+    start_time = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=len(instances))
+    futures = [executor.submit(function, instance) for instance in instances]
+
+    results = []
+    for instance, future in zip(instances, futures):
+        # Each server only gets its own Timeout, counted from when all requests were started
+        done, _ = wait([future], timeout=max(start_time + instance['Timeout'] - time.monotonic(), 0))
+        if future not in done:
+            print(f"{instance['Name']} did not respond within {instance['Timeout']} seconds.")
+        elif future.exception() is not None:
+            print(f"Error getting data from {instance['Name']}: {future.exception()}")
+        else:
+            results.append((instance, future.result()))
+
+    # Do not wait for servers that timed out. Requests should also be given the instance's Timeout so they end soon after.
+    executor.shutdown(wait=False, cancel_futures=True)
+    return results
@@ -0,0 +1,173 @@
+import requests
+import json
+import os
+from datetime import datetime
+from HttpCache import get_json, get_revalidated_json
+
+# Only the TMDB fields used by the reports are kept in the local store
+STORED_FIELDS = ['id', 'title', 'name', 'overview', 'poster_path', 'vote_average', 'number_of_seasons', 'episode_run_time']
+# The ETag and Last-Modified of the TMDB response are kept with the media so a refresh can be revalidated
+VALIDATOR_FIELDS = ['etag', 'last_modified']
+
+# Plex GUID prefixes that TMDB's /find endpoint can resolve, and the matching external source
+external_sources = {'imdb://': 'imdb_id', 'tvdb://': 'tvdb_id'}
+
+# Get the directory where the script is located
+script_directory = os.path.dirname(os.path.abspath(__file__))
+store_path = os.path.join(script_directory, 'TMDBMetadata.json')
+
+
+def load_metadata_store():
+    # 'media' maps '<media_type>/<tmdb_id>' to the stored TMDB fields.
+    # 'external' maps '<media_type>/<external guid>' to the TMDB ID, or None if TMDB has no match.
+    # 'guids' maps '<server name>/<rating key>' to the item's GUIDs and the time Plex last updated the item.
+    store = {'media': {}, 'external': {}, 'guids': {}}
+    if os.path.exists(store_path):
+        with open(store_path, 'r') as store_file:
+            store.update(json.load(store_file))
+    return store
+
+
+def is_store_modified(store):
+    # Used by the reports to only save the store when something was added or refreshed
+    return store.get('modified', False)
+
+
+def save_metadata_store(store):
+    # Write to a temporary file first so an interrupted run cannot corrupt the store
+    store.pop('modified', None)
+    temp_path = f"{store_path}.tmp"
+    with open(temp_path, 'w') as store_file:
+        json.dump(store, store_file)
+    os.replace(temp_path, store_path)
+
+
+def get_stored_media(store, media_type, tmdb_id):
+    return store['media'].get(f"{media_type}/{tmdb_id}")
+
+
+def set_stored_media(store, media_type, media_results):
+    stored_media = {field: media_results[field] for field in STORED_FIELDS + VALIDATOR_FIELDS if field in media_results}
+    stored_media['updated'] = datetime.utcnow().timestamp()
+    store['media'][f"{media_type}/{media_results['id']}"] = stored_media
+    store['modified'] = True
+    return stored_media
+
+
+def get_thumb_updated_at(thumb):
+    # Plex thumb paths end with the time the item was last updated, e.g. /library/metadata/123/thumb/1700000000
+    updated_at = str(thumb or '').rsplit('/', 1)[-1]
+    return int(updated_at) if updated_at.isdigit() else None
+
+
+def get_indexed_guids(store, server_name, rating_key, updated_at=None):
+    # Returns None if the rating key is not indexed, or Plex has refreshed the item since it was indexed
+    indexed_item = store['guids'].get(f"{server_name}/{rating_key}")
+    if indexed_item is None:
+        return None
+    if updated_at is not None and indexed_item['updated_at'] is not None and int(updated_at) > indexed_item['updated_at']:
+        return None
+    return indexed_item['guids']
+
+
+def set_indexed_guids(store, server_name, rating_key, guids, updated_at=None):
+    store['guids'][f"{server_name}/{rating_key}"] = {
+        'guids': guids,
+        'updated_at': int(updated_at) if updated_at not in (None, '') else None
+    }
+    store['modified'] = True
+
+
+def fetch_tmdb_media(tmdb_api_key, media_type, tmdb_id, stored_media=None):
+    # Get the media information straight from TMDB, returning None if it could not be found.
+    # If stored media is given it is revalidated, and returned as it is when TMDB reports it has not changed.
+    media_url = f"https://api.themoviedb.org/3/{media_type}/{tmdb_id}?api_key={tmdb_api_key}&language=en-US"
+    try:
+        media_results, validators = get_revalidated_json(media_url, stored_media)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Error getting TMDB {media_type} {tmdb_id}: {e}")
+        return None
+    if media_results is None:
+        return stored_media
+    if "success" in media_results and media_results["success"] is False:
+        return None
+    return dict(media_results, **(validators or {}))
+
+
+def find_tmdb_id(tmdb_api_key, media_type, external_id, external_source, wait_for_tmdb=None):
+    # Look up the TMDB ID for an IMDB or TVDB ID. Returns None if TMDB has no match.
+    # wait_for_tmdb, if given, is called right before the request to respect a rate limit.
+    find_url = f"https://api.themoviedb.org/3/find/{external_id}?api_key={tmdb_api_key}&language=en-US&external_source={external_source}"
+    if wait_for_tmdb is not None:
+        wait_for_tmdb()
+    find_results = get_json(find_url)
+    # Error bodies (e.g. rate limiting) have no results lists. Raise so they are not stored as "no match".
+    if find_results.get("success") is False or f"{media_type}_results" not in find_results:
+        raise ValueError(find_results.get("status_message", "unexpected response from TMDB /find"))
+    media_results = find_results[f"{media_type}_results"]
+    if media_results:
+        return str(media_results[0]['id'])
+    return None
+
+
+def resolve_tmdb_id(tmdb_api_key, media_type, guids, store, wait_for_tmdb=None):
+    # Resolve the TMDB ID from a Plex item's GUIDs, preferring a tmdb:// GUID, then TMDB's /find
+    # endpoint for imdb:// and tvdb:// GUIDs. Returns None if no GUID could be resolved.
+    tmdb_guid = next((guid for guid in guids if guid.startswith("tmdb://")), None)
+    if tmdb_guid:
+        return tmdb_guid.split("tmdb://")[1]
+
+    for guid in guids:
+        external_source = next((source for prefix, source in external_sources.items() if guid.startswith(prefix)), None)
+        if external_source is None:
+            continue
+
+        external_key = f"{media_type}/{guid}"
+        if external_key not in store['external']:
+            try:
+                store['external'][external_key] = find_tmdb_id(tmdb_api_key, media_type, guid.split('://')[1], external_source, wait_for_tmdb)
+                store['modified'] = True
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"Error finding TMDB ID for {guid}: {e}")
+                continue
+        if store['external'][external_key] is not None:
+            return store['external'][external_key]
+
+    return None
+
+
+def get_tmdb_info(tmdb_api_key, media_type, tmdb_id=None, title=None, year=None, store=None, guids=None):
+    # Read from the local store first, and only fall back to TMDB on a miss.
+    # Anything fetched from TMDB is added to the store; the caller is responsible for saving it.
+    if store is None:
+        store = {'media': {}, 'external': {}, 'guids': {}}
+
+    # Use the item's GUIDs to get the TMDB ID if it was not given
+    if tmdb_id is None and guids:
+        tmdb_id = resolve_tmdb_id(tmdb_api_key, media_type, guids, store)
+
+    # No TMDB ID, so as a last resort we will attempt to search TMDB for the media information
+    if tmdb_id is None:
+        tmdb_url = f"https://api.themoviedb.org/3/search/{media_type}?api_key={tmdb_api_key}&language=en-US&page=1&include_adult=false&query={title}"
+        if year is not None and year != '':
+            tmdb_url += f"&year={year}"
+
+        try:
+            tmdb_results = get_json(tmdb_url)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Error searching TMDB for {title}: {e}")
+            return None
+        # Check if 'results' key exists and the list is not empty
+        if 'results' not in tmdb_results or len(tmdb_results['results']) == 0:
+            return None
+        # Get the first TMDB ID from the search results
+        tmdb_id = tmdb_results['results'][0]['id']
+
+    stored_media = get_stored_media(store, media_type, tmdb_id)
+    if stored_media:
+        return stored_media
+
+    media_results = fetch_tmdb_media(tmdb_api_key, media_type, tmdb_id)
+    if media_results is None:
+        return None
+    return set_stored_media(store, media_type, media_results)
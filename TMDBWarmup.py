@@ -0,0 +1,170 @@
+import requests
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from JSONStream import get_tautulli_rows
+from Servers import get_clients, get_matching_instance
+from TMDBMetadata import fetch_tmdb_media, get_indexed_guids, get_stored_media, get_thumb_updated_at, load_metadata_store, resolve_tmdb_id, save_metadata_store, set_indexed_guids, set_stored_media
+
+# Get the directory where the script is located
+script_directory = os.path.dirname(os.path.abspath(__file__))
+config_path = os.path.join(script_directory, 'config.json')
+
+# Tautulli library section types and the matching TMDB media types
+media_types = {'movie': 'movie', 'show': 'tv'}
+
+
+# Load configuration from the config.json file
+def load_config():
+    with open(config_path, 'r') as config_file:
+        return json.load(config_file)
+
+
+def get_rate_limiter(requests_per_second):
+    # Returns a function that blocks until the next request is allowed, shared between all threads
+    lock = threading.Lock()
+    next_request_time = [0.0]
+
+    def wait():
+        with lock:
+            now = time.monotonic()
+            wait_time = next_request_time[0] - now
+            next_request_time[0] = max(now, next_request_time[0]) + 1 / requests_per_second
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    return wait
+
+
+def run(config, clients):
+    script_name = 'TMDBWarmup'
+    script_settings = config['ScriptSettings'].get(script_name, {})
+    concurrency = script_settings.get('Concurrency', 8)
+    requests_per_second = script_settings.get('RequestsPerSecond', 20)
+    max_age_days = script_settings.get('MaxAgeDays', 30)
+    tautulli_instances = clients['Tautulli']
+    plex_instances = clients['Plex']
+    tmdb_api_key = config['TMDB']['APIKey']
+    page_length = 1000
+
+    def get_tautulli_data(tautulli, params):
+        params = dict(params, apikey=tautulli['APIKey'])
+        response = requests.get(f"{tautulli['Url']}/api/v2", params=params, timeout=tautulli['Timeout'])
+        return response.json()['response']['data']
+
+    def get_library_items(tautulli, section_id):
+        # Page through the library, parsing each page's rows as they arrive so only the rating keys and the
+        # time Plex last updated each item (taken from its thumb) are kept
+        library_items = []
+        start = 0
+        while True:
+            row_count = 0
+            for row in get_tautulli_rows(tautulli, {'cmd': 'get_library_media_info', 'section_id': section_id, 'start': start, 'length': page_length}):
+                library_items.append((row['rating_key'], get_thumb_updated_at(row.get('thumb'))))
+                row_count += 1
+            start += row_count
+            if row_count < page_length:
+                return library_items
+
+    def index_plex_library_guids(tautulli, section_id):
+        # Bulk populate the GUID index from the Plex library listing. Returns False if Plex could not be used.
+        plex = get_matching_instance(plex_instances, tautulli['Name'])
+        if plex is None:
+            return False
+        # Page through the listing so no single response holds the whole library
+        start = 0
+        while True:
+            try:
+                response = requests.get(f"{plex['Url']}/library/sections/{section_id}/all", params={'includeGuids': 1},
+                                        headers={'Accept': 'application/json', 'X-Plex-Token': plex['token'],
+                                                 'X-Plex-Container-Start': str(start), 'X-Plex-Container-Size': str(page_length)},
+                                        timeout=plex['Timeout'])
+                response.raise_for_status()
+                items = response.json()['MediaContainer'].get('Metadata', [])
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                print(f"Error getting library {section_id} from Plex: {e}")
+                return False
+            for item in items:
+                set_indexed_guids(store, tautulli['Name'], item['ratingKey'], [guid['id'] for guid in item.get('Guid', [])], item.get('updatedAt'))
+            start += len(items)
+            if len(items) < page_length:
+                return True
+
+    def get_guids(tautulli, rating_key, updated_at):
+        # Indexed GUIDs are looked up again if Plex has refreshed the item since
+        guids = get_indexed_guids(store, tautulli['Name'], rating_key, updated_at)
+        if guids is not None:
+            return guids
+        try:
+            metadata = get_tautulli_data(tautulli, {'cmd': 'get_metadata', 'rating_key': rating_key})
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            print(f"Error getting metadata for {rating_key}: {e}")
+            return []
+        set_indexed_guids(store, tautulli['Name'], rating_key, metadata.get('guids', []), metadata.get('updated_at'))
+        return metadata.get('guids', [])
+
+    wait_for_tmdb = get_rate_limiter(requests_per_second)
+
+    def fetch_media(media_type, guids):
+        # Resolve the TMDB ID, then fetch the media if it is missing or stale. Returns None if nothing was fetched.
+        # Only the requests actually sent to TMDB wait for the rate limiter.
+        tmdb_id = resolve_tmdb_id(tmdb_api_key, media_type, guids, store, wait_for_tmdb)
+        if tmdb_id is None:
+            return None
+        stored_media = get_stored_media(store, media_type, tmdb_id)
+        if stored_media is not None and stored_media['updated'] >= oldest_update:
+            return None
+        wait_for_tmdb()
+        media_results = fetch_tmdb_media(tmdb_api_key, media_type, tmdb_id, stored_media)
+        if media_results is None:
+            return None
+        return set_stored_media(store, media_type, media_results)
+
+    store = load_metadata_store()
+    oldest_update = datetime.utcnow().timestamp() - max_age_days * 86400
+
+    # Enumerate the movie and show libraries of every server. A server or library that fails is skipped,
+    # and everything fetched so far is saved even if the run is stopped.
+    fetched_count = 0
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for tautulli in tautulli_instances:
+                try:
+                    libraries = get_tautulli_data(tautulli, {'cmd': 'get_libraries'})
+                except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                    print(f"Error getting libraries from {tautulli['Name']}: {e}")
+                    continue
+                for library in libraries:
+                    media_type = media_types.get(library['section_type'])
+                    if media_type is None:
+                        continue
+
+                    # Refresh the GUID index for the whole library at once if Plex is available
+                    index_plex_library_guids(tautulli, library['section_id'])
+                    try:
+                        library_items = get_library_items(tautulli, library['section_id'])
+                    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                        print(f"Error getting {tautulli['Name']} - {library['section_name']} from Tautulli: {e}")
+                        continue
+                    print(f"{tautulli['Name']} - {library['section_name']}: {len(library_items)} items")
+
+                    # Fetch anything missing or stale from TMDB, respecting the rate limit
+                    library_guids = list(executor.map(lambda library_item: get_guids(tautulli, *library_item), library_items))
+                    for stored_media in executor.map(lambda guids: fetch_media(media_type, guids), library_guids):
+                        if stored_media is not None:
+                            fetched_count += 1
+    finally:
+        save_metadata_store(store)
+    print(f"Stored {fetched_count} items. The store now holds {len(store['media'])} items.")
+
+
+def main():
+    config = load_config()
+    run(config, get_clients(config))
+
+
+if __name__ == "__main__":
+    main()
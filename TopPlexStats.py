@@ -2,6 +2,9 @@ import re
 import requests
 import json
 import os
+from ChartRenderer import dispatch_charts, render_bar_chart
+from DiscordPayloads import dispatch, format_code_block, get_destinations, pack_code_blocks
+from Servers import fan_out, get_clients, get_server_stats_count
 
 # Get the directory where the script is located
 script_directory = os.path.dirname(os.path.abspath(__file__))
@@ -14,20 +17,6 @@ def load_config():
         return json.load(config_file)
 
 
-def push_to_discord(webhook, payload):
-    headers = {'Content-Type': 'application/json'}
-    try:
-        response = requests.post(
-            webhook, data=json.dumps(payload), headers=headers)
-        response.raise_for_status()
-        response.cookies
-        print("Data sent to Discord successfully.")
-    except requests.exceptions.RequestException as e:
-        print(f"Error sending to Discord: {e}")
-        print(f"Response content: {response.content}")
-        print(payload)
-
-
 def get_sanitized_string(str_input_string):
     # Credit to FS.Corrupt for the initial version of this function. https://github.com/FSCorrupt
     # This will match any titles with the year appended. I ran into issues with 'Yellowstone (2018)'
@@ -80,21 +69,54 @@ def get_sanitized_string(str_input_string):
     return str_input_string
 
 
-def main():
-    config = load_config()
+def merge_home_stats(server_home_stats):
+    # Merge the home stats of several servers. Plays are summed per user and platform,
+    # and the highest concurrent stream counts are kept.
+    merge_settings = {
+        'top_users': ('friendly_name', 'total_plays', lambda a, b: a + b),
+        'top_platforms': ('platform', 'total_plays', lambda a, b: a + b),
+        'most_concurrent': ('title', 'count', max),
+    }
+    merged_stats = {}
+    for home_stats in server_home_stats:
+        for stat in home_stats:
+            stat_id = stat['stat_id']
+            if stat_id not in merge_settings:
+                continue
+            key_name, value_name, combine = merge_settings[stat_id]
+            merged_rows = merged_stats.setdefault(stat_id, {})
+            for row in stat['rows']:
+                row_key = row.get(key_name, '')
+                if row_key in merged_rows:
+                    merged_rows[row_key][value_name] = combine(
+                        merged_rows[row_key].get(value_name, 0), row.get(value_name, 0))
+                else:
+                    merged_rows[row_key] = dict(row)
+
+    return [{'stat_id': stat_id, 'rows': list(rows.values())} for stat_id, rows in merged_stats.items()]
+
+
+def run(config, clients):
     script_name = 'TopPlexStats'
     script_settings = config['ScriptSettings'][script_name]
-    discord_webhook = script_settings['Webhook']
+    destinations = get_destinations(script_settings)
     count = script_settings['Count']
     days = script_settings['Days']
-    tautulli_url = config['Tautulli']['Url']
-    tautulli_api_key = config['Tautulli']['APIKey']
-
-    # Get Home Stats from Tautulli
-    tautulli_home_stats_url = f"{tautulli_url}/api/v2?apikey={
-        tautulli_api_key}&cmd=get_home_stats&grouping=1&time_range={days}&stats_count={count}"
-    response = requests.get(tautulli_home_stats_url).json()
-    tautulli_home_stats = response['response']['data']
+    charts = script_settings.get('Charts', False)
+    tautulli_instances = clients['Tautulli']
+    # Rows are cut to the top <count> after the servers are merged
+    stats_count = get_server_stats_count(count, tautulli_instances)
+
+    # Get Home Stats from a single Tautulli server
+    def get_server_home_stats(tautulli):
+        tautulli_home_stats_url = (f"{tautulli['Url']}/api/v2?apikey={tautulli['APIKey']}"
+                                   f"&cmd=get_home_stats&grouping=1&time_range={days}&stats_count={stats_count}")
+        response = requests.get(tautulli_home_stats_url, timeout=tautulli['Timeout']).json()
+        return response['response']['data']
+
+    # Get Home Stats from every Tautulli server at once
+    tautulli_home_stats = merge_home_stats(
+        [home_stats for _, home_stats in fan_out(tautulli_instances, get_server_home_stats)])
     all_stats_object = []
 
     for stat in tautulli_home_stats:
@@ -108,7 +130,8 @@ def main():
             for user in top_users:
                 current_stats = {
                     'Metric': user.get('friendly_name', ''),
-                    'Value': f"{user.get('total_plays', 0)} plays"
+                    'Value': f"{user.get('total_plays', 0)} plays",
+                    'Count': user.get('total_plays', 0)
                 }
                 group_stats.append(current_stats)
             all_stats_object.append({
@@ -123,7 +146,8 @@ def main():
             for platform in top_platforms:
                 current_stats = {
                     'Metric': platform.get('platform', ''),
-                    'Value': f"{platform.get('total_plays', 0)} plays"
+                    'Value': f"{platform.get('total_plays', 0)} plays",
+                    'Count': platform.get('total_plays', 0)
                 }
                 group_stats.append(current_stats)
             all_stats_object.append({
@@ -138,7 +162,8 @@ def main():
             for stat in most_concurrent:
                 current_stats = {
                     'Metric': stat.get('title', ''),
-                    'Value': stat.get('count', 0)
+                    'Value': stat.get('count', 0),
+                    'Count': stat.get('count', 0)
                 }
                 group_stats.append(current_stats)
             all_stats_object.append({
@@ -148,18 +173,37 @@ def main():
 
     # print(json.dumps(all_stats_object, indent=2))
 
+    # Render the groups as charts if enabled, falling back to text if they cannot be rendered
+    if charts:
+        chart_paths = [render_bar_chart(group_entry['Group'], [stat['Metric'] for stat in group_entry['Stats']],
+                                        {'Plays': [stat['Count'] for stat in group_entry['Stats']]}, horizontal=True)
+                       for group_entry in all_stats_object if group_entry['Stats']]
+        if chart_paths and None not in chart_paths:
+            dispatch_charts(
+                destinations, chart_paths, f"**Top Plex Stats** for the last **{days}** Days!")
+            return
+
     # Convert results to string and send to Discord
+    sections = []
     for group_entry in all_stats_object:
         group_name = group_entry['Group']
         group_stats = group_entry['Stats']
+        if not group_stats:
+            continue
         max_metric_length = max(len(stat['Metric']) for stat in group_stats)
         template = '{:<{}}\t{}'
         str_body = '\n'.join([template.format(stat['Metric'], max_metric_length,
                                               stat['Value']) for stat in group_stats])
-        payload = {
-            'content': f"**{group_name}** for the last **{days}** Days!\n```\n{str_body}\n```"
-        }
-        push_to_discord(discord_webhook, payload)
+        sections.append(format_code_block(
+            f"**{group_name}** for the last **{days}** Days!", str_body))
+
+    # Combine the groups into as few messages as possible
+    dispatch(destinations, pack_code_blocks(sections))
+
+
+def main():
+    config = load_config()
+    run(config, get_clients(config))
 
 
 if __name__ == "__main__":
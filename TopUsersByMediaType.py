@@ -1,20 +1,10 @@
 import requests
 import json
 import os
-# from datetime import datetime, timedelta
-
-
-def push_to_discord(webhook, payload):
-    headers = {'Content-Type': 'application/json'}
-    try:
-        response = requests.post(
-            webhook, data=json.dumps(payload), headers=headers)
-        response.raise_for_status()
-        response.cookies
-        print("Data sent to Discord successfully.")
-    except requests.exceptions.RequestException as e:
-        print(f"Error sending to Discord: {e}")
-        print(payload)
+from ChartRenderer import dispatch_charts, render_bar_chart
+from DiscordPayloads import dispatch, format_code_block, get_destinations, pack_code_blocks
+from Servers import fan_out, get_clients
+from datetime import datetime, timedelta
 
 
 def get_sanitized_string(input_string):
@@ -33,95 +23,162 @@ def get_sanitized_string(input_string):
     return input_string
 
 
-# Load config from file
+# Get the directory where the script is located
 script_directory = os.path.dirname(os.path.abspath(__file__))
 config_path = os.path.join(script_directory, 'config.json')
 # config_path = 'D:\\GitHub\\Tautulli2Discord-python\\config.json'
 
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
 
-# Script name from config
-script_name = 'TopUsersByMediaType'
+# Load config from file
+def load_config():
+    with open(config_path, 'r') as config_file:
+        return json.load(config_file)
+
+
+# Per user, per media type, per day play counters, advanced incrementally each run
+counters_path = os.path.join(script_directory, 'TopUsersCounters.json')
+
+
+def load_counters(days):
+    # 'servers' holds the last processed reference_id of each server, 'days' the plays per day, media type and user,
+    # 'totals' the plays per media type and user across the window and 'names' the latest name of each user.
+    counters = {'days_setting': days, 'servers': {}, 'days': {}, 'totals': {}, 'names': {}}
+    if os.path.exists(counters_path):
+        with open(counters_path, 'r') as counters_file:
+            stored_counters = json.load(counters_file)
+        # Start over if the window size has changed
+        if stored_counters.get('days_setting') == days:
+            counters = stored_counters
+    return counters
 
-# Assign variables from config
-discord_webhook = config['ScriptSettings'][script_name]['Webhook']
-media_types = config['ScriptSettings'][script_name]['MediaTypes']
-count = config['ScriptSettings'][script_name]['Count']
-days = config['ScriptSettings'][script_name]['Days']
-tautulli_url = config['Tautulli']['Url']
-tautulli_api_key = config['Tautulli']['APIKey']
 
-# SQL query
-query = f"""
+def save_counters(counters):
+    temp_path = f"{counters_path}.tmp"
+    with open(temp_path, 'w') as counters_file:
+        json.dump(counters, counters_file)
+    os.replace(temp_path, counters_path)
+
+
+def add_play(counters, day, media_type, user_id, plays=1):
+    user_id = str(user_id)
+    day_plays = counters['days'].setdefault(day, {}).setdefault(media_type, {})
+    day_plays[user_id] = day_plays.get(user_id, 0) + plays
+    total_plays = counters['totals'].setdefault(media_type, {})
+    total_plays[user_id] = total_plays.get(user_id, 0) + plays
+
+
+def expire_days(counters, first_day):
+    # Subtract the days that have aged out of the window from the totals
+    for day in [day for day in counters['days'] if day < first_day]:
+        for media_type, day_plays in counters['days'].pop(day).items():
+            total_plays = counters['totals'][media_type]
+            for user_id, plays in day_plays.items():
+                total_plays[user_id] -= plays
+                if total_plays[user_id] <= 0:
+                    del total_plays[user_id]
+
+
+# SQL query for the plays newer than the last processed reference_id, one row per play
+def get_query(last_reference_id, days):
+    return f"""
 SELECT
-COALESCE(
-   MAX(
-      CASE
-         WHEN friendly_name IS NOT NULL AND TRIM(friendly_name) <> '' THEN friendly_name
-      END
-   ),
-   MAX(
-      CASE
-         WHEN username IS NOT NULL AND TRIM(username) <> '' THEN username
-         ELSE 'Unknown'
-      END
-   )
-) AS FriendlyName,
+session_history.reference_id AS ReferenceId,
+session_history.user_id AS UserId,
+date(MAX(session_history.stopped), 'unixepoch', 'localtime') AS Day,
 CASE
-   WHEN media_type = 'episode' THEN 'TV'
-   WHEN media_type = 'movie' THEN 'Movies'
-   WHEN media_type = 'track' THEN 'Music'
-   ELSE media_type
-END AS MediaType,
-count(user) AS Plays
-FROM (
-   SELECT
-   session_history.user,
-   session_history.user_id,
-   users.username,
-   users.friendly_name,
-   started,
-   session_history_metadata.media_type
-   FROM session_history
-   JOIN session_history_metadata
-      ON session_history_metadata.id = session_history.id
-   LEFT OUTER JOIN users
-      ON session_history.user_id = users.user_id
-   WHERE datetime(session_history.stopped, 'unixepoch', 'localtime') >= datetime('now', '-{days} days', 'localtime')
-   AND users.user_id <> 0
-   GROUP BY session_history.reference_id
-) AS Results
-GROUP BY user, media_type
+   WHEN users.friendly_name IS NOT NULL AND TRIM(users.friendly_name) <> '' THEN users.friendly_name
+   WHEN users.username IS NOT NULL AND TRIM(users.username) <> '' THEN users.username
+   ELSE 'Unknown'
+END AS FriendlyName,
+CASE
+   WHEN session_history_metadata.media_type = 'episode' THEN 'TV'
+   WHEN session_history_metadata.media_type = 'movie' THEN 'Movies'
+   WHEN session_history_metadata.media_type = 'track' THEN 'Music'
+   ELSE session_history_metadata.media_type
+END AS MediaType
+FROM session_history
+JOIN session_history_metadata
+   ON session_history_metadata.id = session_history.id
+LEFT OUTER JOIN users
+   ON session_history.user_id = users.user_id
+WHERE session_history.reference_id > {int(last_reference_id)}
+AND datetime(session_history.stopped, 'unixepoch', 'localtime') >= datetime('now', '-{days} days', 'localtime')
+AND users.user_id <> 0
+GROUP BY session_history.reference_id
 """
 
-# Execute Tautulli query
-tautulli_query_results = requests.get(
-    f"{tautulli_url}/api/v2?apikey={tautulli_api_key}&cmd=sql&query={query}").json()
-top_users_by_media_type = {}
-
-# print(json.dumps(tautulli_query_results['response']['data'], indent=2))
-
-# Organize data by MediaType
-for entry in tautulli_query_results['response']['data']:
-    media_type = entry['MediaType']
-    if media_type not in top_users_by_media_type:
-        top_users_by_media_type[media_type] = []
-    top_users_by_media_type[media_type].append(entry)
-
-# print(json.dumps(top_users_by_media_type['TV'], indent=2))
-
-# Process and send results to Discord
-for media_type, plays in top_users_by_media_type.items():
-    sorted_users = sorted(
-        plays, key=lambda x: x['Plays'], reverse=True)[:count]
-    max_friendly_name_length = max(
-        len(user['FriendlyName']) for user in sorted_users)
-    template = '{:<{}}\t{}'
-    str_body = '\n'.join([template.format(user['FriendlyName'], max_friendly_name_length,
-                                          user['Plays']) for user in sorted_users])
-    payload = {
-        'content': f"**Top {count} users in {media_type}** for the last **{days}** Days!\n```\n{str_body}\n```"
-    }
 
-    push_to_discord(discord_webhook, payload)
+def run(config, clients):
+    # Script name from config
+    script_name = 'TopUsersByMediaType'
+    script_settings = config['ScriptSettings'][script_name]
+
+    # Assign variables from config
+    destinations = get_destinations(script_settings)
+    media_types = script_settings['MediaTypes']
+    count = script_settings['Count']
+    days = script_settings['Days']
+    charts = script_settings.get('Charts', False)
+
+    counters = load_counters(days)
+    first_day = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+
+    # Execute Tautulli query on a single server
+    def get_server_plays(tautulli):
+        last_reference_id = counters['servers'].get(tautulli['Name'], 0)
+        response = requests.get(f"{tautulli['Url']}/api/v2", params={
+            'apikey': tautulli['APIKey'], 'cmd': 'sql', 'query': get_query(last_reference_id, days)}, timeout=tautulli['Timeout'])
+        return response.json()['response']['data']
+
+    # Execute Tautulli query on every server at once. Plays of users found on several servers are summed.
+    for tautulli, server_plays in fan_out(clients['Tautulli'], get_server_plays):
+        for play in server_plays:
+            counters['names'][str(play['UserId'])] = play['FriendlyName']
+            if play['Day'] >= first_day:
+                add_play(counters, play['Day'], play['MediaType'], play['UserId'])
+        if server_plays:
+            counters['servers'][tautulli['Name']] = max(play['ReferenceId'] for play in server_plays)
+    expire_days(counters, first_day)
+    save_counters(counters)
+
+    # Organize data by MediaType
+    top_users_by_media_type = {}
+    for media_type, total_plays in counters['totals'].items():
+        if total_plays:
+            top_users_by_media_type[media_type] = [
+                {'FriendlyName': counters['names'].get(user_id, 'Unknown'), 'MediaType': media_type, 'Plays': plays}
+                for user_id, plays in total_plays.items()
+            ]
+
+    # Process results
+    sections = []
+    chart_paths = []
+    for media_type, plays in top_users_by_media_type.items():
+        sorted_users = sorted(
+            plays, key=lambda x: x['Plays'], reverse=True)[:count]
+        max_friendly_name_length = max(
+            len(user['FriendlyName']) for user in sorted_users)
+        template = '{:<{}}\t{}'
+        str_body = '\n'.join([template.format(user['FriendlyName'], max_friendly_name_length,
+                                              user['Plays']) for user in sorted_users])
+        sections.append(format_code_block(
+            f"**Top {count} users in {media_type}** for the last **{days}** Days!", str_body))
+        if charts:
+            chart_paths.append(render_bar_chart(f"Top {count} users in {media_type}", [user['FriendlyName'] for user in sorted_users],
+                                                {media_type: [user['Plays'] for user in sorted_users]}, horizontal=True))
+
+    # Send the charts if they could all be rendered, otherwise send results to Discord as text in as few messages as possible
+    if chart_paths and None not in chart_paths:
+        dispatch_charts(
+            destinations, chart_paths, f"**Top {count} users by media type** for the last **{days}** Days!")
+    else:
+        dispatch(destinations, pack_code_blocks(sections))
+
+
+def main():
+    config = load_config()
+    run(config, get_clients(config))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+# Get the directory where the script is located
+script_directory = os.path.dirname(os.path.abspath(__file__))
+default_config_path = os.path.join(script_directory, 'config.json')
+
+# Every report, with the module that runs it, its ScriptSettings section, the services it queries and the settings it requires.
+# Report modules are only imported when they are run, so a single report does not pay for the imports of the others.
+reports = {
+    'CurrentStreams': {'Module': 'CurrentStreams', 'Settings': 'CurrentStreams', 'Services': ['Tautulli'], 'Required': [], 'TMDB': True},
+    'PlexLibraryStats': {'Module': 'PlexLibraryStats', 'Settings': 'PlexLibraryStats', 'Services': ['Tautulli'], 'Required': ['ExcludedLibraries'], 'TMDB': False},
+    'PlaysForLast12Months': {'Module': 'PlaysForLast12Months', 'Settings': 'PlexPlayStats', 'Services': ['Tautulli'], 'Required': ['MediaTypes', 'RemoveMonthsWithZeroPlays'], 'TMDB': False},
+    'PopularOnPlex': {'Module': 'PopularOnPlex', 'Settings': 'PopularOnPlex', 'Services': ['Tautulli'], 'Required': ['Count', 'Days'], 'TMDB': True},
+    'SABnzbdStatus': {'Module': 'SABnzbdStatus', 'Settings': 'SABnzbdStatus', 'Services': ['SABnzbd'], 'Required': [], 'TMDB': False},
+    'TMDBWarmup': {'Module': 'TMDBWarmup', 'Settings': None, 'Services': ['Tautulli'], 'Required': [], 'TMDB': True},
+    'TopPlexStats': {'Module': 'TopPlexStats', 'Settings': 'TopPlexStats', 'Services': ['Tautulli'], 'Required': ['Count', 'Days'], 'TMDB': False},
+    'TopUsersByMediaType': {'Module': 'TopUsersByMediaType', 'Settings': 'TopUsersByMediaType', 'Services': ['Tautulli'], 'Required': ['MediaTypes', 'Count', 'Days'], 'TMDB': False},
+}
+
+# The keys every server of a service needs
+service_keys = {'Tautulli': ['Url', 'APIKey'], 'Plex': ['Url', 'token'], 'SABnzbd': ['Url', 'APIKey']}
+
+
+def get_config_errors(config, report_names):
+    # Check the config against what the chosen reports need and return a list of problems
+    errors = []
+    for service, keys in service_keys.items():
+        instances = config.get(service, [])
+        if isinstance(instances, dict):
+            instances = [instances]
+        if not isinstance(instances, list):
+            errors.append(f"{service} must be a server or a list of servers.")
+            continue
+        for index, instance in enumerate(instances):
+            for key in keys:
+                if not instance.get(key):
+                    errors.append(f"{service} server {instance.get('Name', index + 1)} is missing {key}.")
+
+    for report_name in report_names:
+        report = reports[report_name]
+        for service in report['Services']:
+            if not config.get(service):
+                errors.append(f"{report_name} needs at least one {service} server.")
+        if report['TMDB'] and not config.get('TMDB', {}).get('APIKey'):
+            errors.append(f"{report_name} needs TMDB.APIKey.")
+        if report['Settings'] is None:
+            continue
+
+        script_settings = config.get('ScriptSettings', {}).get(report['Settings'])
+        if script_settings is None:
+            errors.append(f"ScriptSettings.{report['Settings']} is missing.")
+            continue
+        if 'Destinations' in script_settings:
+            if not script_settings['Destinations'] or not all(destination.get('Webhook') for destination in script_settings['Destinations']):
+                errors.append(f"Every destination of ScriptSettings.{report['Settings']} needs a Webhook.")
+        elif not script_settings.get('Webhook'):
+            errors.append(f"ScriptSettings.{report['Settings']} needs a Webhook or Destinations.")
+        for key in report['Required']:
+            if key not in script_settings:
+                errors.append(f"ScriptSettings.{report['Settings']} is missing {key}.")
+    return errors
+
+
+def main():
+    start_time = time.perf_counter()
+    parser = argparse.ArgumentParser(prog='t2d', description='Send Tautulli, Plex and SABnzbd reports to Discord.')
+    parser.add_argument('reports', nargs='+', choices=sorted(reports), metavar='report',
+                        help=f"one or more of: {', '.join(sorted(reports))}")
+    parser.add_argument('--config', default=default_config_path, help='path to config.json')
+    parser.add_argument('--timings', action='store_true', help='print how long each import and report took')
+    args = parser.parse_args()
+
+    # Parse and check the config once for every report in this run
+    with open(args.config, 'r') as config_file:
+        config = json.load(config_file)
+    config_errors = get_config_errors(config, args.reports)
+    if config_errors:
+        for error in config_errors:
+            print(f"Config error: {error}")
+        sys.exit(1)
+
+    from Servers import get_clients
+    clients = get_clients(config)
+    timings = [('Startup', time.perf_counter() - start_time)]
+
+    failed = False
+    for report_name in args.reports:
+        import_start = time.perf_counter()
+        report_module = importlib.import_module(reports[report_name]['Module'])
+        run_start = time.perf_counter()
+        try:
+            report_module.run(config, clients)
+        except Exception as e:
+            # Keep going so one failing report does not stop the others
+            print(f"Error running {report_name}: {e}")
+            failed = True
+        timings.append((f"{report_name} import", run_start - import_start))
+        timings.append((f"{report_name} run", time.perf_counter() - run_start))
+
+    if args.timings:
+        for name, seconds in timings:
+            print(f"{name}: {seconds:.3f}s")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()